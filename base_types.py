@@ -30,7 +30,6 @@ class BaseType:
     con = None  # Construct class for this type, if applicable
 
     def __init__(self):
-        self._refs = set()
         self._symbols = set()
         self._usage = set()
 
@@ -49,9 +48,6 @@ class BaseType:
         else:
             return self.shortstr()
 
-    def addRef(self, ref):
-        self._refs.add(ref.TI)
-
     def type_size(self):
         return self.size
 
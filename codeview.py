@@ -1,11 +1,11 @@
 from construct import *
 from constructutils import *
+from neoconstruct import struct, NeoStruct
 
 from typing import *
 import textwrap
 from varint import VarInt
 
-from tpi import TypeIndex
 
 
 CVSwitch = {}
@@ -18,68 +18,61 @@ def CVRec(type):
         return cls
     return decorator
 
+class TypeRef:
+    # A TypeIndex which is resolved straight to its type, all the records ever kept of it
+    neo_format = "H"
+
+    @staticmethod
+    def neo_decode(value, ctx):
+        return ctx._params.types.types[value]
+
 @CVRec(0x1) # S_COMPILE
-class CompileFlags(ConstructClass):
-    subcon = Struct(
-        "Machine" / Int8ul,
-        "Flags" / BitStruct(
-            "Language" / BitsInteger(8),
-            "PCode" / Flag,
-            "FloatPrecision" / BitsInteger(2),
-            "FloatPackage" / BitsInteger(2),
-            "AmbientData" / BitsInteger(3),
-            "AmbientCode" / BitsInteger(3),
-            "Mode32" / Flag,
-            Padding(4)
-        ),
-        "CompilerVersion" / PascalString(Int8ul, "ascii"),
+@struct(dynamic=True)
+class CompileFlags:
+    Machine: Int8ul
+    Flags: BitStruct(
+        "Language" / BitsInteger(8),
+        "PCode" / Flag,
+        "FloatPrecision" / BitsInteger(2),
+        "FloatPackage" / BitsInteger(2),
+        "AmbientData" / BitsInteger(3),
+        "AmbientCode" / BitsInteger(3),
+        "Mode32" / Flag,
+        Padding(4)
     )
+    CompilerVersion: PascalString(Int8ul, "ascii")
 
 @CVRec(0x3) # S_CONSTANT_16t
-class Constant(ConstructClass):
-    subcon = Struct(
-        "Type" / TypeIndex,
-        "Value" / VarInt, # cvinfo.h claims this is always a short, but it's actually VarInt
-        "Name" / PascalString(Int8ul, "ascii"),
-    )
-
-    def parsed(self, ctx):
-        self.Type = self.Type.Type
+@struct(dynamic=True)
+class Constant:
+    Type: TypeRef
+    Value: VarInt # cvinfo.h claims this is always a short, but it's actually VarInt
+    Name: PascalString(Int8ul, "ascii")
 
 @CVRec(0x4) # S_UDT_16t
-class UserDefinedType(ConstructClass):
-    subcon = Struct(
-        "Type" / TypeIndex,
-        "Name" / PascalString(Int8ul, "ascii"),
-    )
-
-    def parsed(self, ctx):
-        self.Type = self.Type.Type
+@struct(dynamic=True)
+class UserDefinedType:
+    Type: TypeRef
+    Name: PascalString(Int8ul, "ascii")
 
 @CVRec(0x6) # S_END
-class End(ConstructClass):
-    subcon = Struct()
-
+@struct(dynamic=True)
+class End:
     def __str__(self):
         return "End"
 
 @CVRec(0x9) # S_OBJNAME_ST
-class ObjName(ConstructClass):
-    subcon = Struct(
-        "Sig" / Int32ul, # Usually 0, but sometimes 1 for xmt_obj files
-        "Name" / PascalString(Int8ul, "ascii"),
-    )
+@struct(dynamic=True)
+class ObjName:
+    Sig: Int32ul # Usually 0, but sometimes 1 for xmt_obj files
+    Name: PascalString(Int8ul, "ascii")
 
 @CVRec(0x200) # S_BPREL32_16t
-class BpRelative(ConstructClass):
-    subcon = Struct(
-        "Offset" / Int32sl,
-        "Type" / TypeIndex,
-        "Name" / PascalString(Int8ul, "ascii"),
-    )
-
-    def parsed(self, ctx):
-        self.Type = self.Type.Type
+@struct(dynamic=True)
+class BpRelative:
+    Offset: Int32sl
+    Type: TypeRef
+    Name: PascalString(Int8ul, "ascii")
 
 def getContrib(sym, program):
     try:
@@ -90,10 +83,10 @@ def getContrib(sym, program):
         except IndexError:
             raise Exception(f"Segment {sym.Segment} not found for symbol {sym}")
 
-        try:
-            contrib = section.contribs[sym.Offset].pop().data
+        contrib = section.contribs.find(sym.Offset)
+        if contrib is not None:
             sym.contribOffset = sym.Offset - contrib.Offset
-        except KeyError:
+        else:
             contrib = program.unknownContribs
             sym.contribOffset = None
 
@@ -101,16 +94,12 @@ def getContrib(sym, program):
         sym.contrib = contrib
         return contrib
 
-class DataSym(ConstructClass):
-    subcon = Struct(
-            "Offset" / Int32ul,
-            "Segment" / Int16ul,
-            "Type" / TypeIndex,
-            "Name" / PascalString(Int8ul, "ascii"),
-        )
-
-    def parsed(self, ctx):
-        self.Type = self.Type.Type
+@struct(dynamic=True)
+class DataSym:
+    Offset: Int32ul
+    Segment: Int16ul
+    Type: TypeRef
+    Name: PascalString(Int8ul, "ascii")
 
     def getContrib(self, program):
         return getContrib(self, program)
@@ -132,31 +121,32 @@ class PublicData(DataSym):
     pass
 
 class TreeNode:
+    # Records using this must have a _children slot, see toTree
+    __slots__ = ()
+
     def __str__(self):
-        return "\n".join([ ConstructClass.__str__(self) ] + [textwrap.indent(str(child), "    ") for child in self.children() ])
+        return "\n".join([ NeoStruct.__str__(self) ] + [textwrap.indent(str(child), "    ") for child in self.children() ])
 
     def children(self):
         return getattr(self, '_children', [])
 
 
 
-class ProcSym(TreeNode, ConstructClass):
-    subcon = Struct(
-        "pParent" / Int32ul,
-        "pEnd" / Int32ul,
-        "pNext" / Int32ul,
-        "Len" / Int32ul,
-        "DbgStart" / Int32ul,
-        "DbgEnd" / Int32ul,
-        "Offset" / Int32ul,
-        "Segment" / Int16ul,
-        "Type" / TypeIndex,
-        "Flags" / Int8ul,
-        "Name" / PascalString(Int8ul, "ascii"),
-    )
+@struct(dynamic=True)
+class ProcSym(TreeNode):
+    __slots__ = ("_children",)
 
-    def parsed(self, ctx):
-        self.Type = self.Type.Type
+    pParent: Int32ul
+    pEnd: Int32ul
+    pNext: Int32ul
+    Len: Int32ul
+    DbgStart: Int32ul
+    DbgEnd: Int32ul
+    Offset: Int32ul
+    Segment: Int16ul
+    Type: TypeRef
+    Flags: Int8ul
+    Name: PascalString(Int8ul, "ascii")
 
     def getContrib(self, program):
         return getContrib(self, program)
@@ -180,19 +170,20 @@ class GlobalProcedureStart(ProcSym):
         return False
 
 @CVRec(0x206) # S_THUNK32
-class Thunk(TreeNode, ConstructClass):
+@struct(dynamic=True)
+class Thunk(TreeNode):
     # These are functions imported by dlls
-    subcon = Struct(
-        "pParent" / Int32ul,
-        "pEnd" / Int32ul,
-        "pNext" / Int32ul,
-        "Offset" / Int32ul,
-        "Segment" / Int16ul,
-        "Len" / Int16ul,
-        "Ordinal" / Int8ul,
-        "Name" / PascalString(Int8ul, "ascii"),
-        "variant" / HexDump(GreedyBytes)
-    )
+    __slots__ = ("_children",)
+
+    pParent: Int32ul
+    pEnd: Int32ul
+    pNext: Int32ul
+    Offset: Int32ul
+    Segment: Int16ul
+    Len: Int16ul
+    Ordinal: Int8ul
+    Name: PascalString(Int8ul, "ascii")
+    variant: HexDump(GreedyBytes)
 
     def getContrib(self, program):
         return getContrib(self, program)
@@ -202,37 +193,36 @@ class Thunk(TreeNode, ConstructClass):
         return contrib.ModuleIndex
 
 @CVRec(0x207) # S_BLOCK32
-class BlockStart(TreeNode, ConstructClass):
-    subcon = Struct(
-        "pParent" / Int32ul,
-        "pEnd" / Int32ul,
-        "Length" / Int32ul,
-        "Offset" / Int32ul,
-        "Segment" / Int16ul,
-        "Name" / PascalString(Int8ul, "ascii"),
-    )
+@struct(dynamic=True)
+class BlockStart(TreeNode):
+    __slots__ = ("_children",)
+
+    pParent: Int32ul
+    pEnd: Int32ul
+    Length: Int32ul
+    Offset: Int32ul
+    Segment: Int16ul
+    Name: PascalString(Int8ul, "ascii")
 
 @CVRec(0x209) # S_LABEL32_ST
-class CodeLabel(ConstructClass):
-    subcon = Aligned(4, Struct(
-        "Offset" / Int32ul,
-        "Segment" / Int16ul,
-        "Flags" / Const(0, Int8ul),
-        "Name" / PascalString(Int8ul, "ascii"),
-    ))
+@struct(align=4, dynamic=True)
+class CodeLabel:
+    Offset: Int32ul
+    Segment: Int16ul
+    Flags: Const(0, Int8ul)
+    Name: PascalString(Int8ul, "ascii")
 
 
-class RefSym(ConstructClass):
+@struct(dynamic=True)
+class RefSym:
     # This doesn't match microsoft's documentation, where RefSym doesn't have a name.
     # Instead, vc++ 4.1 seems to output a corrupted record where the length matches RefSym2,
     # but the name actually exists. This means the length of this record is far too short.
-    subcon = Struct(
-        "SucOfName" / Int32ul, # I have no idea what "SUC" is, always appears to be zero
-        "SymbolOffset" / Int32ul,  # offset into $$Symbols table (I think this is the local symbols of the referenced module)
-        "ModuleId" / Int16ul,  # Module containing actual symbol
-        "Fill"    /  Int16ul,  # is this just padding?
-        "Name"    /  PascalString(Int8ul, "ascii"),  # Hidden name that has been made a first class member
-    )
+    SucOfName: Int32ul # I have no idea what "SUC" is, always appears to be zero
+    SymbolOffset: Int32ul  # offset into $$Symbols table (I think this is the local symbols of the referenced module)
+    ModuleId: Int16ul  # Module containing actual symbol
+    Fill: Int16ul  # is this just padding?
+    Name: PascalString(Int8ul, "ascii")  # Hidden name that has been made a first class member
 
     def parsed(self, ctx):
         assert self.SucOfName == 0, f"Unexpected SucOfName value {self.SucOfName} in {self.Name}"
@@ -255,63 +245,82 @@ class LocalProcRef(RefSym):
 
 
 @CVRec(0x040a) # LF_VFUNCTAB_16t
-class VirtualFunctionTable(ConstructClass):
-    subcon = Struct(
-        "Type" / TypeIndex,
-    )
-
-    def parsed(self, ctx):
-        self.Type = self.Type.Type
-
-class CodeviewRecord(ConstructClass):
-    subcon = Aligned(4, Struct(
-        "RecordLength" / Int16ul,
-        "RecordType" / Int16ul,
-        "_length_fixed" / IfThenElse(lambda ctx: ctx.RecordType in (0x400, 0x401, 0x403),
+@struct(dynamic=True)
+class VirtualFunctionTable:
+    Type: TypeRef
+
+# Records with the RefSym length bug
+REF_KINDS = (0x400, 0x401, 0x403)
+
+class RecordData:
+    # The record's Data, parsed by the CVSwitch class for its RecordType
+    @staticmethod
+    def neo_parse(rec, buf, off, end, ctx):
+        if rec.RecordType in REF_KINDS:
             # This is a hack to fix the length of the RefSym record types
-            FocusedSeq("Length",
-                "Ref" / Peek(RefSym),
-                "Length" / Computed(lambda ctx: len(ctx.Ref.Name) + 13)
-            ),
-            Computed(this.RecordLength - 2),
-        ),
-        StopIf(lambda ctx: ctx.RecordLength < 2),
-        "Data" / FixedSized(this._length_fixed, Switch(this.RecordType, CVSwitch,
-            #default=HexDump(GreedyBytes)
-            default=Error
-        )),
-    ))
-
-    def parsed(self, ctx):
-        pass
-        #print(f"Record: {self.RecordLength} {self.RecordType:04x}\n\t{self.Data}")
+            length = buf[off + 12] + 13
+        elif rec.RecordLength < 2:
+            return None, off
+        else:
+            length = rec.RecordLength - 2
 
-def split_list(lst, pred):
-    for i, item in enumerate(lst):
-        if pred(item):
-            return lst[:i], lst[i+1:]
-    return [], lst
+        try:
+            cls = CVSwitch[rec.RecordType]
+        except KeyError:
+            raise ExplicitError(f"Unknown codeview record type {rec.RecordType:#x} at {rec._addr:#x}")
+        data, _ = cls.parse_from(buf, off, off + length, ctx)
+        return data, off + length
 
+@struct(align=4)
+class CodeviewRecord:
+    RecordLength: Int16ul
+    RecordType: Int16ul
+    Data: RecordData
 
 def toTree(records: List[CodeviewRecord]):
+    # Single pass over the records. A record with a pEnd opens a scope, which collects
+    # everything up to the record at the pEnd address (the End record is dropped).
+    # Like the old recursive version, a scope whose end is never found (before its parent's end)
+    # gets no children, and whatever it collected goes back to the parent.
     tree = []
+    current = tree
+    stack = [] # (record, pEnd, parent's list)
+    ends = {}  # pEnd -> depth of the outermost open scope waiting for it
+
+    def unmatched():
+        nonlocal current
+        record, pEnd, parent = stack.pop()
+        if ends.get(pEnd) == len(stack):
+            del ends[pEnd]
+        record._children = []
+        parent.extend(current)
+        current = parent
+
+    for rec in records:
+        depth = ends.get(rec._addr)
+        if depth is not None:
+            while len(stack) > depth + 1:
+                unmatched()
+            record, pEnd, parent = stack.pop()
+            del ends[pEnd]
+            record._children = current
+            current = parent
+            continue
 
-    while len(records) > 0:
-        #print("Records:", len(records))
-        #print(records)
-        record = records.pop(0).Data
-        #pEnd = 0
+        record = rec.Data
+        current.append(record)
         try:
             pEnd = record.pEnd
         except:
             # This record has no children
-            tree.append(record)
             continue
 
-        children, records = split_list(records, lambda x: x._addr == pEnd)
-        #print("Children:", len(children))
-        record._children = toTree(children)
-        tree.append(record)
+        stack.append((record, pEnd, current))
+        ends.setdefault(pEnd, len(stack) - 1)
+        current = []
+
+    while stack:
+        unmatched()
 
     return tree
 
@@ -88,6 +88,7 @@ class MzHeader(ConstructClass):
     )
 
 class DataDirectory(ConstructClass):
+    compiled_parse = True
     subcon = Struct(
         "VirtualAddress" / Int32ul,
         "Size" / Int32ul,
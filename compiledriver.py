@@ -55,7 +55,7 @@ def compile_single(sourcecode):
     pdb_file = SRC_DIR + 'temp.pdb'
 
     exe = Executable(exe_file)
-    data = pdb_parser.ProgramData(pdb_file, exe, timeit=False)
+    data = pdb_parser.ProgramData(pdb_file, exe, timeit=False, lazy_types=True)
     p = Program(data)
     p.post_process(module=0)
 
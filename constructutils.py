@@ -1,7 +1,9 @@
 #!/usr/bin/env python3
 # SPDX-License-Identifier: MIT
-import inspect, textwrap, json, re, sys, os, time
+import inspect, textwrap, json, re, sys, os, time, types, functools, hashlib
+import pathlib
 
+import construct
 from construct import *
 from construct.core import evaluate
 from construct.lib import HexDisplayedInteger
@@ -288,6 +290,69 @@ def sizeof(subcon, value, parent=None):
 
     raise Exception(f"Don't know how to calculate size for {subcon}")
 
+class SizeofMethod:
+    # sizeof() on a class sizes the construct, on a parsed object it returns the parsed size.
+    # Saves every object from carrying its own bound obj_sizeof around
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self.fn.__get__(cls)
+        return obj.obj_sizeof
+
+# Where compile_subcon() keeps the parsers construct generates, between runs.
+# In the user's cache dir rather than the source tree.
+COMPILE_CACHE_DIR = pathlib.Path(os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache") / "simcopter_tool" / "construct"
+
+def _load_compiled(source, subcon):
+    # The same as the end of Construct.compile()
+    module = types.ModuleType(hashlib.sha1(source.encode()).hexdigest())
+    exec(compile(source, "", "exec"), module.__dict__)
+    compiled = module.compiled
+    compiled.source = source
+    compiled.module = module
+    compiled.modulename = module.__name__
+    compiled.defersubcon = subcon
+    return compiled
+
+def compile_subcon(cls):
+    """
+    Returns cls.subcon compiled by construct, or None if it can't be compiled.
+    The generated code is cached on disk, keyed on the source of the module defining cls.
+    Code which links to construct objects (for subcons construct can't compile) isn't cached,
+    as it refers to them by id.
+    """
+    try:
+        h = hashlib.sha1(pathlib.Path(inspect.getsourcefile(cls)).read_bytes())
+        h.update(f"{cls.__qualname__} {construct.version_string}".encode())
+        filename = COMPILE_CACHE_DIR / f"{cls.__module__}.{cls.__qualname__}-{h.hexdigest()[:16]}.py"
+    except (OSError, TypeError):
+        filename = None
+
+    if filename is not None and filename.exists():
+        return _load_compiled(filename.read_text(), cls.subcon)
+
+    try:
+        compiled = cls.subcon.compile()
+    except Exception as e:
+        print(f"Couldn't compile {cls.__name__}: {e}", file=sys.stderr)
+        return None
+
+    if filename is not None and not compiled.module.linkedinstances:
+        try:
+            COMPILE_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            for old in COMPILE_CACHE_DIR.glob(f"{cls.__module__}.{cls.__qualname__}-*.py"):
+                old.unlink()
+            tmp = filename.with_suffix(".tmp")
+            tmp.write_text(compiled.source)
+            os.replace(tmp, filename)
+        except OSError as e:
+            # Only a cache, it's compiled again next run
+            print(f"Couldn't cache compiled {cls.__name__}: {e}", file=sys.stderr)
+
+    return compiled
+
 class ConstructClassBase(Reloadable, metaclass=ReloadableConstructMeta):
     """ Offers two benifits over regular construct
 
@@ -312,16 +377,23 @@ class ConstructClassBase(Reloadable, metaclass=ReloadableConstructMeta):
 
     parsed = None
 
+    # Skips recomputing the field offsets of variable sized classes after every parse,
+    # they are worked out by field_offsets() when something asks for them instead
+    fast_parse = True
+
+    # Parse with construct's compiled version of subcon, see compile_subcon().
+    # Only worth it for fixed layouts that are parsed a lot.
+    compiled_parse = False
+
     def __init__(self):
         self._pointers = set()
         self._addr = None
         self._meta = {}
-        object.__setattr__(self, "sizeof", self.obj_sizeof)
 
     def regmap(self):
         return ConstructRegMap(type(self), self._stream.to_accessor(), self._addr)
 
-    @classmethod
+    @SizeofMethod
     def sizeof(cls, **contextkw):
         context = Container(**contextkw)
         context._parsing = False
@@ -389,11 +461,100 @@ class ConstructClassBase(Reloadable, metaclass=ReloadableConstructMeta):
         newcls = Reloadable._reloadcls.__func__(cls, force)
         if hasattr(newcls, "subcon"):
             recusive_reload(newcls.subcon, token)
+            if "_compiled_subcon" in newcls.__dict__:
+                # Might refer to the old classes
+                del newcls._compiled_subcon
         return newcls
 
     def _apply(self, obj):
         raise NotImplementedError()
 
+    @classmethod
+    def _compute_off(cls, top_ctx, offs):
+        # Fills in offs with the offset and size of each field, given the parsed values in top_ctx
+        top_ctx._parsing = True
+        top_ctx._sizing = True
+        top_ctx._building = False
+
+        off = 0
+        for subcon in cls.subcon.subcons:
+            name = None
+            ctx = top_ctx
+            size = None
+
+            if isinstance(subcon, Ver):
+                if not subcon._active():
+                    continue
+                subcon = subcon.subcon
+
+            if isinstance(subcon, Renamed):
+                name = subcon.name
+                subcon = subcon.subcon
+
+                const_off, size = offs[name]
+
+                if const_off and size:
+                    off = const_off + size
+                    continue
+
+                if size:
+                    if name:
+                        offs[name] = off, size
+                    off += size
+                    continue
+            else:
+                size = subcon._sizeof(ctx, "(sizeof)")
+
+            if not size:
+                if isinstance(ctx[name], ConstructClass):
+                    size = ctx[name].sizeof()
+                else:
+                    size = sizeof(subcon, ctx[name], parent=ctx)
+
+            if name:
+                offs[name] = off, size
+
+            off += size
+
+    def field_offsets(self):
+        """
+        (offset, size) of each field of this object.
+        With fast_parse, variable sized classes don't work these out while parsing, so they
+        are computed here from the parsed values. That can fail for fields whose size depends
+        on the parent's context (or which parsed() has changed), those are left as None.
+        """
+        cls = type(self)
+        if cls._fixed_sized or not cls.fast_parse:
+            return cls._off
+
+        offs = dict(cls._off)
+        top_ctx = Container((k, v) for k, v in dict.items(self) if not k.startswith("_"))
+        top_ctx._ = Container()
+        top_ctx._params = Container()
+        try:
+            cls._compute_off(top_ctx, offs)
+        except Exception:
+            pass
+        return offs
+
+    @classmethod
+    def _pointer_fields(cls):
+        # Names of the Pointer fields, these don't depend on any offsets
+        try:
+            return cls.__dict__["_pointer_names"]
+        except KeyError:
+            pass
+        names = []
+        for subcon in cls.subcon.subcons:
+            if isinstance(subcon, Ver):
+                if not subcon._active():
+                    continue
+                subcon = subcon.subcon
+            if isinstance(subcon, Renamed) and isinstance(subcon.subcon, Pointer):
+                names.append(subcon.name)
+        cls._pointer_names = tuple(names)
+        return cls._pointer_names
+
     @classmethod
     def _set_meta(cls, self, stream=None):
         if stream is not None:
@@ -402,14 +563,20 @@ class ConstructClassBase(Reloadable, metaclass=ReloadableConstructMeta):
             self._stream = stream
 
         if isinstance(cls.subcon, Struct):
-            base_addr = int(self._addr)
             stream_has_meta = stream is not None and hasattr(stream, "meta_fn")
+            if cls.fast_parse and not stream_has_meta:
+                # Without meta, all the walk below finds is the pointers
+                self._pointers.update(cls._pointer_fields())
+                return
+
+            offs = self.field_offsets()
+            base_addr = int(self._addr)
             for subcon in cls.subcon.subcons:
                 if isinstance(subcon, Ver):
                     subcon = subcon.subcon
                 if isinstance(subcon, Renamed):
                     name = subcon.name
-                    offset, sizeof = self._off[name]
+                    offset, sizeof = offs[name]
                     if offset is None:
                         continue
                     subaddr = base_addr + offset
@@ -436,11 +603,23 @@ class ConstructClassBase(Reloadable, metaclass=ReloadableConstructMeta):
                     #                 i.set_addr(subaddr)
                     #                 subaddr += i.sizeof()
 
+    @classmethod
+    def _parse_subcon(cls):
+        try:
+            return cls.__dict__["_compiled_subcon"]
+        except KeyError:
+            pass
+        subcon = cls.subcon
+        if cls.compiled_parse:
+            subcon = compile_subcon(cls) or subcon
+        cls._compiled_subcon = subcon
+        return subcon
+
     @classmethod
     def _parse(cls, stream, context, path):
         #print(f"parse {cls} @ {stream.tell():#x} {path}")
         addr = stream.tell()
-        obj = cls.subcon._parse(stream, context, path)
+        obj = cls._parse_subcon()._parse(stream, context, path)
 
         # Don't instance Selects (and other raw subcons)
         if not isinstance(obj, Container) and not issubclass(cls, ConstructValueClass):
@@ -453,58 +632,13 @@ class ConstructClassBase(Reloadable, metaclass=ReloadableConstructMeta):
         #self._path = path
         self._meta = {}
         self._size = stream.tell() - addr
-        if self.sizeof.__func__ == ConstructClassBase.sizeof.__func__:
-            object.__setattr__(self, "sizeof", self.obj_sizeof)
 
-        if not cls._fixed_sized:
+        if not cls._fixed_sized and not cls.fast_parse:
             # rerun the offset calculation, now we have actual data
-
             top_ctx = obj.copy()
             top_ctx._ = context
             top_ctx._params = context._params
-            top_ctx._parsing = True
-            top_ctx._sizing = True
-            top_ctx._building = False
-
-            off = 0
-            for subcon in cls.subcon.subcons:
-                name = None
-                ctx = top_ctx
-                size = None
-
-                if isinstance(subcon, Ver):
-                    if not subcon._active():
-                        continue
-                    subcon = subcon.subcon
-
-                if isinstance(subcon, Renamed):
-                    name = subcon.name
-                    subcon = subcon.subcon
-
-                    const_off, size = self._off[name]
-
-                    if const_off and size:
-                        off = const_off + size
-                        continue
-
-                    if size:
-                        if name:
-                            self._off[name] = off, size
-                        off += size
-                        continue
-                else:
-                    size = subcon._sizeof(ctx, "(sizeof)")
-
-                if not size:
-                    if isinstance(ctx[name], ConstructClass):
-                        size = ctx[name].sizeof()
-                    else:
-                        size = sizeof(subcon, ctx[name], parent=ctx)
-
-                if name:
-                    self._off[name] = off, size
-
-                off += size
+            cls._compute_off(top_ctx, self._off)
 
         self._apply(obj)
 
@@ -575,7 +709,7 @@ class ConstructClass(ConstructClassBase, Container):
     def __eq__(self, other):
         return all(self[k] == other[k] for k in self
                    if (not k.startswith("_"))
-                   and (k not in self._pointers)
+                   and (k not in self.get("_pointers", ()))
                    and not callable(self[k]))
 
     def __str__(self, ignore=[], other=None, show_all=False) -> str:
@@ -586,12 +720,13 @@ class ConstructClass(ConstructClassBase, Container):
 
         str += "\n"
 
+        offs = self.field_offsets()
         keys = list(self)
-        keys.sort(key = lambda x: self._off.get(x, (-1, 0))[0] or -1)
+        keys.sort(key = lambda x: offs.get(x, (-1, 0))[0] or -1)
 
         for key in keys:
-            if key in self._off:
-                offv, sizeof = self._off[key]
+            if key in offs:
+                offv, sizeof = offs[key]
                 if offv == -1:
                     #print(key, offv, sizeof)
                     continue
@@ -600,12 +735,12 @@ class ConstructClass(ConstructClassBase, Container):
             value = getattr(self, key)
             need_diff = False
             if other is not None:
-                if key in self._pointers or callable(value):
+                if key in self.get("_pointers", ()) or callable(value):
                     continue
                 other_value = getattr(other, key)
                 if not show_all and other_value == value:
                     continue
-                offv, sizeof = self._off[key]
+                offv, sizeof = offs[key]
                 if sizeof == 0:
                     continue
                 def _valdiff(value, other_value):
@@ -638,8 +773,8 @@ class ConstructClass(ConstructClassBase, Container):
                 val_repr = str_value(value)
             off = ""
             meta = ""
-            if key in self._off:
-                offv, sizeof = self._off[key]
+            if key in offs:
+                offv, sizeof = offs[key]
                 if sizeof is not None:
                     sizeofs = f"{sizeof:3x}"
                 else:
@@ -648,7 +783,7 @@ class ConstructClass(ConstructClassBase, Container):
                     off = f"\x1b[32m[err.{sizeofs}]\x1b[m "
                 else:
                     off = f"\x1b[32m[{offv:3x}.{sizeofs}]\x1b[m "
-            if key in self._meta:
+            if key in self.get("_meta", {}):
                 meta = f" \x1b[34m{self._meta[key]}\x1b[m"
             if '\n' in val_repr:
                 val_repr = textwrap.indent(val_repr, f'\x1b[90m{self.short_name:>5s}.\x1b[m')
@@ -665,8 +800,9 @@ class ConstructClass(ConstructClassBase, Container):
         if self._addr is not None:
             print(f"#  Address: 0x{self._addr:x}")
 
+        offs = self.field_offsets()
         keys = list(self)
-        keys.sort(key = lambda x: self._off.get(x, (-1, 0))[0])
+        keys.sort(key = lambda x: offs.get(x, (-1, 0))[0] or -1)
         for key in keys:
             if key.startswith('_'):
                 continue
@@ -768,7 +904,7 @@ class ConstructClass(ConstructClassBase, Container):
             yield k, self[k]
 
     def addrof(self, name):
-        return self._addr + self._off[name][0]
+        return self._addr + self.field_offsets()[name][0]
 
     @classmethod
     def offsetof(cls, name):
@@ -1028,8 +1164,69 @@ class Ver(Subconstruct):
         cls.set_version_key("V", u.version)
         cls.set_version_key("G", u.adt["/arm-io"].soc_generation.replace("H", "G"))
 
+@functools.cache
+def slot_names(cls):
+    names = []
+    for c in cls.__mro__:
+        slots = c.__dict__.get("__slots__", ())
+        if isinstance(slots, str):
+            slots = (slots,)
+        names += [name for name in slots if name not in ("__dict__", "__weakref__")]
+    return tuple(names)
+
+# Only needed while parsing, see freeze()
+PARSE_ONLY_KEYS = ("_io", "_stream", "_meta", "_pointers")
+
+def freeze(obj, seen=None, skip=()):
+    """
+    Strips the parsing bookkeeping (io objects, meta and pointer sets) from every construct object
+    reachable from obj, which is a large part of their memory. _addr and _size are kept.
+    Pass the same seen set to multiple calls to avoid walking shared objects (like types) again,
+    or the classes of objects which are already frozen as skip.
+    """
+    if seen is None:
+        seen = set()
+
+    work = [obj]
+    while work:
+        obj = work.pop()
+        if id(obj) in seen or isinstance(obj, (str, bytes, int, float, type, types.ModuleType,
+                types.FunctionType, types.MethodType, types.BuiltinFunctionType)):
+            continue
+        if skip and isinstance(obj, skip):
+            continue
+        seen.add(id(obj))
+
+        if isinstance(obj, dict):
+            if isinstance(obj, Container) and any(k in obj for k in PARSE_ONLY_KEYS):
+                # Rebuild rather than delete, dicts never shrink
+                items = [(k, v) for k, v in dict.items(obj) if k not in PARSE_ONLY_KEYS]
+                dict.clear(obj)
+                dict.update(obj, items)
+            work.extend(dict.values(obj))
+            # Container attributes are dict items, touching __dict__ would only allocate one
+            continue
+        if isinstance(obj, (list, tuple, set, frozenset)):
+            work.extend(obj)
+            continue
+
+        slots = slot_names(type(obj))
+        if slots:
+            # Slotted objects don't carry parse bookkeeping, anything in their __dict__ (if they have
+            # one) was added after parsing, and touching it would only allocate it.
+            for name in slots:
+                work.append(getattr(obj, name, None))
+            continue
+
+        d = getattr(obj, "__dict__", None)
+        if d is not None:
+            if isinstance(obj, ConstructClassBase):
+                for k in PARSE_ONLY_KEYS + ("sizeof",):
+                    d.pop(k, None)
+            work.extend(d.values())
+
 def show_struct_trace(log=print):
     for addr, desc in sorted(list(g_struct_trace)):
         log(f"{addr:>#18x}: {desc}")
 
-__all__ = ["ConstructClass", "ConstructValueClass", "Dec", "ROPointer", "show_struct_trace", "ZPadding", "Ver"]
+__all__ = ["ConstructClass", "ConstructValueClass", "Dec", "ROPointer", "show_struct_trace", "ZPadding", "Ver", "freeze"]
@@ -4,26 +4,8 @@ import codeview
 from pdb_parser import ProgramData
 from coff import Executable
 
-import construct
-
-import pickle, os, sys
-from collections import OrderedDict
-
-def better_getstate(self):
-    ret = OrderedDict(self)
-    try:
-        del ret["_io"]
-    except KeyError:
-        pass
-    try:
-        del ret["_stream"]
-    except KeyError:
-        pass
-
-    return ret
-
-# monkey patch container to filter out all io objects
-construct.Container.__getstate__ = better_getstate
+import os, sys
+from parsecache import ParseCache
 
 if __name__ == "__main__":
     import sys
@@ -33,39 +15,11 @@ if __name__ == "__main__":
     pdb_file = "../debug_build_beta/COPTER_D.PDB"
     exe_file = "../debug_build_beta/COPTER_D.EXE"
 
-    print("loading cache...    ", file=sys.stderr, end='', flush=True)
-    now = time.time()
-
-    try:
-        # check if we have a cache
-        modified = os.path.getmtime('cache.pkl')
-        with open("cache.pkl", "rb") as f:
-            cached_file, depends = pickle.load(f)
-            if cached_file != (pdb_file, exe_file):
-                raise Exception(f"wrong file")
-
-            for file in depends:
-                if os.path.getmtime(file) > modified:
-                    raise Exception(f"{file} has been modified")
-
-            cached_data = pickle.load(f)
-            elapsed = int((time.time() - now) * 1000)
-            print(f"done, {elapsed} ms", file=sys.stderr)
-
-    except Exception as e:
-        print(f"Cache load failed because: {e}", file=sys.stderr)
-
-        exe = Executable(exe_file)
-        cached_data = ProgramData(pdb_file, exe)
-
-        # dump to cache
-        with open("cache.pkl", "wb") as f:
-            depends = [m.__file__ for m in sys.modules.values() if hasattr(m, '__file__') and m.__file__ not in (__file__, None)]
-            pickle.dump(((pdb_file, exe_file), depends), f)
-            pickle.dump(cached_data, f)
+    # Shards are only re-parsed when the PDB/EXE or the code that parses them changes
+    cache = ParseCache("cache", pdb_file, exe_file)
 
-# avoid importing things until after the cache is loaded
-# otherwise they will get counted as dependencies
+    exe = Executable(exe_file)
+    cached_data = ProgramData(pdb_file, exe, workers=os.cpu_count(), cache=cache)
 
 from program import Program
 from dump import dump
@@ -82,7 +36,8 @@ if __name__ == "__main__":
     print("post-processing...    ", file=sys.stderr, end='', flush=True)
     now = time.time()
 
-    p.post_process()
+    # Threads only pay off when the GIL is disabled, otherwise fork worker processes
+    p.post_process(workers=os.cpu_count(), threads=not sys._is_gil_enabled())
 
     elapsed = int((time.time() - now) * 1000)
     print(f"done, {elapsed} ms", file=sys.stderr)
@@ -16,6 +16,38 @@ import pydemangler
 
 extrafiles = defaultdict(list)
 
+def symbol_module(p, sym):
+    try:
+        if sym.contrib.module:
+            return sym.contrib.module
+    except AttributeError:
+        pass
+    try:
+        if moduleId := sym.getModuleId(p):
+            return p.modules[moduleId]
+    except AttributeError:
+        pass
+    return None
+
+def nearest_module(p, sym, above):
+    # Walk outwards from sym through the public symbols by address, until we find one with a known module
+    segment, offset = sym.Segment, sym.Offset
+    while True:
+        if above:
+            offset += 1
+        elif offset == 0:
+            return None
+        else:
+            offset -= 1
+
+        syms = p.globals.fromSegmentOffset(segment, offset, nearest=True, above=above)
+        if not syms:
+            return None
+        for other in syms:
+            if module := symbol_module(p, other):
+                return module
+        offset = syms[0].Offset
+
 def dump(p: Program, dest: str):
     extrafiles.clear()
 
@@ -28,41 +60,9 @@ def dump(p: Program, dest: str):
             p.moduleByName[override.lower()].unknowns += [(sym, None)]
             continue
 
-        after = None
-        before = None
-        for idx in range(sym.index - 1, 0, -1):
-            try:
-                contrib = p.globals[idx].contrib
-                if contrib.module:
-                    #print(f"After {contrib.module.sourceFile}")
-                    after = contrib.module
-                    break
-            except:
-                try:
-                    moduleId = p.globals[idx].getModuleId(p)
-                    if moduleId:
-                        #print(f"After {p.modules[moduleId].sourceFile}")
-                        after = p.modules[moduleId]
-                        break
-                except AttributeError:
-                    continue
-        for idx in range(sym.index, len(p.globals)):
-            try:
-                contrib = p.globals[idx].contrib
-                if contrib.module:
-                    #print(f"Before {contrib.module.sourceFile}\n")
-                    before = contrib.module
-                    break
-            except:
-                try:
-                    moduleId = p.globals[idx].getModuleId(p)
-                    if moduleId:
-                        #print(f"Before {p.modules[moduleId].sourceFile}\n")
-
-                        before = p.modules[moduleId]
-                        break
-                except AttributeError:
-                    continue
+        # Look for the closest symbols by address, on either side, that we know the module of
+        after = nearest_module(p, sym, above=False)
+        before = nearest_module(p, sym, above=True)
         if before == after:
             # The trivial case. We found symbols for the same module before and after.
             # it probally belongs to that module.
@@ -1,8 +1,9 @@
+from array import array
+from bisect import bisect_left
 from collections import defaultdict
 from itertools import pairwise
 import textwrap
 
-from iced_x86 import Decoder
 import base_types
 import codeview
 from intervaltree import IntervalTree
@@ -85,6 +86,10 @@ class Function(Item):
         self.external_targets = set()
         self.backedges = set()  # backedges in the control flow graph
 
+        # every instruction in the function, decoded once by find_all_basic_blocks
+        self.code = []
+        self.code_offsets = array('I')
+
         labels = defaultdict(list)
         for (offset, line) in lines.items():
             labels[offset].append(Line(offset, line))
@@ -148,12 +153,12 @@ class Function(Item):
                             # We need to find a pointer typeinfo
                             try:
                                 class_TI = self.ret.TI
-                                _refs = self.ret._refs
                             except AttributeError:
                                 return
-                            types = [program.types.types[x] for x in _refs]
+                            types = [program.types.types[x] for x in program.types.refsTo(class_TI)]
                             ptr = [x for x in types if isinstance(x, tpi.LfPointer) and x.Type.TI == class_TI]
                             if ptr:
+                                # Only the symbol is patched, so none of the cached type strings change
                                 child.Type = ptr[0]
 
                 case codeview.LocalData():
@@ -208,8 +213,12 @@ class Function(Item):
     def is_library(self):
         return self.source_file and "msdev\\include" in self.source_file.lower()
 
+    def has_body(self):
+        # Only functions with code which isn't from the library headers get their body parsed
+        return not self.is_library() and self.contrib
+
     def post_process(self):
-        if not self.is_library() and self.contrib:
+        if self.has_body():
             self.parse_body()
 
     def find_all_basic_blocks(self, labels):
@@ -223,10 +232,16 @@ class Function(Item):
         fallthrough = set()
         extern = dict()
 
-        # decode all instructions to find jump targets
-        decoder = Decoder(32, data, ip=addr)
-        while decoder.can_decode:
-            inst = decoder.decode()
+        code = self.code
+        code_offsets = self.code_offsets
+
+        # walk all instructions to find jump targets
+        sweep = self.p.sweeps[self.codeview.Segment]
+        code_end = addr + len(data)
+        insts = sweep.decode(addr, code_end)
+        while (inst := next(insts, None)) is not None:
+            code.append(inst)
+            code_offsets.append(inst.ip32 - addr)
 
             match inst.mnemonic:
                 case M.JMP if inst.op_kind(0) == x86.OpKind.MEMORY:
@@ -261,9 +276,7 @@ class Function(Item):
                         labels[end_offset] += []
 
                         # restart decoding after the switch table
-                        diff = end - inst.next_ip32
-                        decoder.ip += diff
-                        decoder.position += diff
+                        insts = sweep.decode(end, code_end)
 
                     else:
                         # Reused switch table
@@ -352,6 +365,28 @@ class Function(Item):
             aa.fallthrough = bb
             bb.fallfrom = aa
 
+    def instructions(self, start, end):
+        """Returns the decoded instructions between the offsets start and end"""
+        if start == end:
+            return []
+        i = bisect_left(self.code_offsets, start)
+        j = bisect_left(self.code_offsets, end, i)
+        if i < j and self.code_offsets[i] == start and self.code[j - 1].next_ip32 - self.address == end:
+            return self.code[i:j]
+
+        # start or end isn't on an instruction boundary, decode that range on its own
+        return x86.disassemble(self.data()[start:end], self.address + start)
+
+    def post_process_objects(self):
+        """
+        Returns the nodes of the body, and everything parse_body can reference which already exists
+        before it runs. Both in a stable order, so a forked worker can refer to them by index.
+        """
+        nodes = list(self.body.values())
+        labels = [label for bb in nodes if isinstance(bb, BasicBlock) for label in bb.labels]
+        scopes = [self.scope] + [label.scope for label in labels if isinstance(label, BlockStart)]
+        return nodes, [self, *nodes, *labels, *scopes, *self.local_vars, *self.args, *self.code]
+
     def parse_body(self):
         self.prolog, tail = match_prolog(self.body[0])
         if tail:
@@ -15,23 +15,42 @@
 from construct import *
 from constructutils import *
 
-from codeview import CodeviewRecord
+from codeview import CodeviewRecord, CVSwitch, REF_KINDS
+from neoconstruct import context
+from tpi import TypeLeaf
+from base_types import BaseType
+from pdbhash import lhash
 
+from array import array
+from bisect import bisect_left, bisect_right
 from enum import Enum
+import functools
+import struct
 
 class HRFile(ConstructClass):
     # This is the on-disk format for the GSI/PGSI hash tables
+    compiled_parse = True
     subcon = Struct(
         "offset" / Int32sl, #
         "RefrenceCount" / Int32sl,
     )
 
 class HashEntry:
+    __slots__ = ("offset", "refcount", "ty")
+
     def __init__(self, offset, refcount, ty=None):
         self.offset = offset
         self.refcount = refcount
         self.ty = ty
 
+# Number of hash buckets, the stream has one more for the free list
+GSI_BUCKETS = 4096
+
+def symbol_name(rec):
+    # Accepts both the CodeviewRecord wrappers and the stripped records
+    rec = getattr(rec, "Data", rec)
+    return getattr(rec, "Name", None)
+
 class Gsi(ConstructClass):
     # There is no header for this version of the GSI stream.
     # Instead, there are some number of hashes, followed by exactly 4097 buckets
@@ -66,6 +85,40 @@ class Gsi(ConstructClass):
         del self.hashes
         del self.buckets
 
+        # Only known once we can look up names, see check()
+        self.hashed = None
+
+    def check(self, symbols, samples=8):
+        # Make sure the names we can see hash to the buckets they are in
+        checked = 0
+        for i, bucket in enumerate(self.map[:GSI_BUCKETS]):
+            for entry in bucket:
+                name = symbol_name(symbols.fromOffset(entry.offset - 1))
+                if name is None:
+                    continue
+                if lhash(name) % GSI_BUCKETS != i:
+                    return False
+                checked += 1
+                if checked == samples:
+                    return True
+        return True
+
+    def lookup(self, name, symbols):
+        """
+        Returns the records from symbols which are named `name`, by walking the hash bucket for it.
+        Falls back to checking every entry if the buckets don't match our hash function.
+        """
+        if self.hashed is None:
+            self.hashed = self.check(symbols)
+        entries = self.map[lhash(name) % GSI_BUCKETS] if self.hashed else self.all_hashes
+
+        found = []
+        for entry in entries:
+            rec = symbols.fromOffset(entry.offset - 1)
+            if symbol_name(rec) == name:
+                found.append(rec)
+        return found
+
     def apply_visablity(self, visablity, symbols):
         for sym in self.all_hashes:
             rec = symbols.fromOffset(sym.offset - 1)
@@ -96,22 +149,157 @@ class Pgsi(ConstructClass):
     # PGSI does have a header, as it also contains the address map
     # The first HashesBytes of the stream (after the 0x1c byte header) can be decoded the same way as GSI
 
-    # I'm not entirely sure what address map is. I think it's just a list of all records in the symbol record stream
+    # The address map is the symbol record stream offset of every public symbol, sorted by address
     subcon = Struct(
         "header" / PsgiHeader,
         "gsi" / FixedSized(this.header.HashesBytes, Gsi),
         "addrmap" / Array(this.header.AddrMapBytes // 4, Int32ul),
     )
 
+    def parsed(self, ctx):
+        self.addrmap = array('I', self.addrmap)
+
+    def addresses(self, records):
+        # (segment, offset, index) of each public symbol in the address map, read from the framed SymbolRecords
+        index = records.index
+        return records.addresses(index[offset] for offset in self.addrmap if offset in index)
+
+    def lookup(self, name, symbols):
+        return self.gsi.lookup(name, symbols)
+
+class AddrMap:
+    """
+    Symbol indices sorted by (segment, offset), so addresses can be bisected.
+    The symbols are only fetched with load() once a lookup returns them.
+    """
+    def __init__(self, addresses, load):
+        # addresses are (segment, offset, index), so symbols at the same address stay in index order
+        addresses = sorted(addresses)
+        self.keys = array('Q', (segment << 32 | offset for segment, offset, _ in addresses))
+        self.indices = array('I', (i for _, _, i in addresses))
+        self.load = load
+
+    def at(self, segment, offset):
+        # All symbols at exactly this address
+        key = segment << 32 | offset
+        return [self.load(i) for i in self.indices[bisect_left(self.keys, key):bisect_right(self.keys, key)]]
+
+    def nearest(self, segment, offset, above=False):
+        # All symbols at the closest address at or below this one (or at or above), within the same segment
+        key = segment << 32 | offset
+        if above:
+            i = bisect_left(self.keys, key)
+            if i == len(self.keys) or self.keys[i] >> 32 != segment:
+                return []
+            return self.at(segment, self.keys[i] & 0xffffffff)
+
+        i = bisect_right(self.keys, key)
+        if i == 0 or self.keys[i - 1] >> 32 != segment:
+            return []
+        return self.at(segment, self.keys[i - 1] & 0xffffffff)
+
+    def __len__(self):
+        return len(self.keys)
+
 class Visablity(Enum):
     Unknown = 0
     Global = 1
     Public = 2
 
-def LoadSymbols(symbolRecordStream, types):
+@functools.cache
+def address_fields(kind):
+    """
+    The offsets of Segment and Offset in the data of a record kind, None if the kind doesn't have an address.
+    Lets addresses be read from the framed records without decoding them.
+    """
+    offsets = getattr(CVSwitch.get(kind), "offsets", {})
+    try:
+        return offsets["Segment"][0], offsets["Offset"][0]
+    except KeyError:
+        return None
+
+class SymbolRecords:
+    """
+    The symbol record stream, framed up front by walking just the record length prefixes.
+    Records are only decoded (and then cached) when they are accessed, so looking up the
+    handful of records a GSI/PGSI bucket points at doesn't require parsing the whole stream.
+    """
+
+    # Records with the RefSym length bug, see RecordData
+    ref_kinds = REF_KINDS
+
+    def __init__(self, stream, types, frozen=False):
+        self.types = types
+        self.ctx = context(types=types)
+        # Strip the parsing bookkeeping from records as they are decoded, see freeze()
+        self.frozen = frozen
+
+        stream.seek(0)
+        self.buf = buf = bytes(stream.read())
+
+        self.offsets = array('I')
+        self.kinds = array('H')
+
+        unpack = struct.Struct("<HH").unpack_from
+        name_off = 12 # RefSym.Name follows SucOfName, SymbolOffset, ModuleId and Fill
+        off = 0
+        size = len(buf)
+        while off < size:
+            length, kind = unpack(buf, off)
+            if kind in self.ref_kinds:
+                data_length = buf[off + 4 + name_off] + name_off + 1
+            elif length < 2:
+                data_length = 0
+            else:
+                data_length = length - 2
+            self.offsets.append(off)
+            self.kinds.append(kind)
+            off += (4 + data_length + 3) & ~3
+
+        self.index = {off: i for i, off in enumerate(self.offsets)}
+        self.records = [None] * len(self.offsets)
+
+    def load(self, i):
+        rec = self.records[i]
+        if rec is None:
+            rec, _ = CodeviewRecord.parse_from(self.buf, self.offsets[i], len(self.buf), self.ctx)
+            self.records[i] = rec
+            if self.frozen:
+                # The types were frozen along with the rest of the TPI
+                freeze(rec, skip=(TypeLeaf, BaseType))
+        return rec
+
+    def fromOffset(self, offset):
+        try:
+            i = self.index[offset]
+        except KeyError:
+            return None
+        return self.load(i)
+
+    def addresses(self, indices=None):
+        # (segment, offset, index) of every record with an address, or just those of indices
+        buf = self.buf
+        if indices is None:
+            indices = range(len(self.offsets))
+        for i in indices:
+            off = self.offsets[i]
+            if fields := address_fields(self.kinds[i]):
+                segment, offset = fields
+                yield (int.from_bytes(buf[off + 4 + segment:off + 6 + segment], "little"),
+                       int.from_bytes(buf[off + 4 + offset:off + 8 + offset], "little"), i)
+
+    def byKind(self, kind):
+        return [self.load(i) for i, k in enumerate(self.kinds) if k == kind]
+
+    def __getitem__(self, i):
+        return self.load(i)
+
+    def __len__(self):
+        return len(self.offsets)
 
-    symbols = RepeatUntil(lambda x, lst, ctx: x._io.tell() == symbolRecordStream.size,
-            Aligned(4, CodeviewRecord)
-        ).parse_stream(symbolRecordStream, types=types)
+    def __iter__(self):
+        for i in range(len(self.offsets)):
+            yield self.load(i)
 
-    return symbols
+def LoadSymbols(symbolRecordStream, types, frozen=False):
+    return SymbolRecords(symbolRecordStream, types, frozen)
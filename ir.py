@@ -1,8 +1,6 @@
 from access import AddressOf, ArrayAccess, ScaleExpr
 from ref import FunctionRef, BasicBlockRef
 
-scope = None
-
 class Expression:
     inst = None
 
@@ -104,7 +102,7 @@ class Const(RValue):
 
 class Addr(LValue):
     # constant address
-    def __init__(self, addr):
+    def __init__(self, addr, scope):
         self.addr = addr
         self.scope = scope
 
@@ -113,7 +111,7 @@ class Addr(LValue):
 
 class Displace(LValue):
     # adds a displacement to an address
-    def __init__(self, expr, displacement):
+    def __init__(self, expr, displacement, scope):
         self.addr = expr
         self.disp = displacement
         self.scope = scope
@@ -123,7 +121,7 @@ class Displace(LValue):
 
 class Index(LValue):
     # adds a scaled index to an address
-    def __init__(self, base_expr, index_expr, scale):
+    def __init__(self, base_expr, index_expr, scale, scope):
         self.base_expr = base_expr
         self.index_expr = index_expr
         self.scale = scale
@@ -134,7 +132,7 @@ class Index(LValue):
 
 class Mem(LValue):
     __match_args__ = ("size", "expr")
-    def __init__(self, size, base, displacement=0, index=None, scale=1):
+    def __init__(self, size, base, displacement=0, index=None, scale=1, scope=None):
 
         self.scope = scope
         self.size = size
@@ -151,12 +149,12 @@ class Mem(LValue):
         if index:
             if not index.expr:
                 return
-            expr = Index(expr, index.expr, scale)
+            expr = Index(expr, index.expr, scale, scope)
         if displacement:
             if not expr:
-                expr = Addr(self.disp)
+                expr = Addr(self.disp, scope)
             else:
-                expr = Displace(expr, displacement)
+                expr = Displace(expr, displacement, scope)
         self.expr = expr
 
     def __repr__(self):
@@ -238,8 +236,8 @@ class Mem(LValue):
 
 class MemBase(Mem):
     __match_args__ = ("base", "size")
-    def __init__(self, size, base):
-        super().__init__(size, base)
+    def __init__(self, size, base, scope=None):
+        super().__init__(size, base, scope=scope)
 
     def __repr__(self):
         if self.expr:
@@ -248,8 +246,8 @@ class MemBase(Mem):
 
 class MemDisp(Mem):
     __match_args__ = ("disp", "size")
-    def __init__(self, size, displacement):
-        super().__init__(size, None, displacement)
+    def __init__(self, size, displacement, scope=None):
+        super().__init__(size, None, displacement, scope=scope)
 
     def __repr__(self):
         if self.expr:
@@ -264,8 +262,8 @@ class MemDisp(Mem):
 
 class MemBaseDisp(Mem):
     __match_args__ = ("base", "disp", "size")
-    def __init__(self, size, base, displacement):
-        super().__init__(size, base, displacement)
+    def __init__(self, size, base, displacement, scope=None):
+        super().__init__(size, base, displacement, scope=scope)
 
     def __repr__(self):
         if self.expr:
@@ -273,8 +271,8 @@ class MemBaseDisp(Mem):
         return f"MemBaseDisp(size={self.size}, base={self.base}, disp={self.disp})"
 
 class MemIndexed(Mem):
-    def __init__(self, size, index, scale, displacement):
-        super().__init__(size, None, displacement, index, scale)
+    def __init__(self, size, index, scale, displacement, scope=None):
+        super().__init__(size, None, displacement, index, scale, scope)
 
     def __repr__(self):
         if self.expr:
@@ -290,8 +288,8 @@ class MemIndexed(Mem):
         return f"{access.deref(offset, self.size)}"
 
 class MemComplex(Mem):
-    def __init__(self, size, base, index, scale, displacement=0):
-        super().__init__(size, base, displacement, index, scale)
+    def __init__(self, size, base, index, scale, displacement=0, scope=None):
+        super().__init__(size, base, displacement, index, scale, scope)
 
     def __repr__(self):
         if self.expr:
@@ -299,7 +297,7 @@ class MemComplex(Mem):
         return f"MemComplex(size={self.size}, base={self.base}, index={self.index}, scale={self.scale}, displacement={self.disp})"
 
 class LocalVar(Mem):
-    def __init__(self, size, displacement):
+    def __init__(self, size, displacement, scope):
         #super().__init__(size, base="EBP", displacement=displacement)
         self.size = size
         self.disp = displacement
@@ -326,7 +324,7 @@ class LocalVar(Mem):
 class SegOverride(Mem):
     __match_args__ = ("segment", "mem")
     def __init__(self, segment, mem):
-        super().__init__(mem.size, mem.base, mem.disp, mem.index, mem.scale)
+        super().__init__(mem.size, mem.base, mem.disp, mem.index, mem.scale, mem.scope)
         self.mem = mem
         self.segment = segment
 
@@ -510,11 +508,32 @@ class ZeroExtend(LValue):
 
 
 from iced_x86 import Decoder, Instruction, OpKind, Register, Mnemonic as M, OpAccess, InstructionInfoFactory, Code
-info_factory = InstructionInfoFactory()
-
-from x86 import formatter, REG_TO_STRING, memsize
+import threading
+
+from x86 import new_formatter, REG_TO_STRING, memsize
+
+# iced's formatter and info factory can't be shared between threads
+thread_tools = threading.local()
+
+def tools():
+    try:
+        return thread_tools.formatter, thread_tools.info_factory
+    except AttributeError:
+        thread_tools.formatter = new_formatter()
+        thread_tools.info_factory = InstructionInfoFactory()
+        return thread_tools.formatter, thread_tools.info_factory
+
+class LiftContext:
+    """
+    Everything lifting instructions needs, other than the register/stack State.
+    Passed explicitly so functions can be lifted on several threads at once.
+    """
+    def __init__(self, scope):
+        self.scope = scope
+        self.formatter, self.info_factory = tools()
 
-def process_operand(inst, info, i, state):
+def process_operand(inst, info, i, state, ctx):
+    formatter = ctx.formatter
     op = formatter.get_instruction_operand(inst, i)
     if op is None:
          return formatter.format_operand(inst, i)
@@ -550,7 +569,7 @@ def process_operand(inst, info, i, state):
 
         case OpKind.NEAR_BRANCH32:
             addr = inst.near_branch32
-            target = scope.code_ref(inst.ip32, addr)
+            target = ctx.scope.code_ref(inst.ip32, addr)
             if not target:
                 return formatter.format_operand(inst, i)
             return target
@@ -565,7 +584,7 @@ def process_operand(inst, info, i, state):
 
             # todo: handle indexed ebp
             assert inst.memory_index == Register.NONE
-            return LocalVar(size, disp)
+            return LocalVar(size, disp, ctx.scope)
 
         case OpKind.MEMORY if inst.memory_base not in (Register.FS, Register.GS):
             disp = inst.memory_displacement
@@ -581,15 +600,15 @@ def process_operand(inst, info, i, state):
                 return formatter.format_operand(inst, i)
 
             if index and base:
-                mem = MemComplex(size, base, index, scale, disp)
+                mem = MemComplex(size, base, index, scale, disp, ctx.scope)
             elif index:
-                mem = MemIndexed(size, index, scale, disp)
+                mem = MemIndexed(size, index, scale, disp, ctx.scope)
             elif not base:
-                mem = MemDisp(size,  disp)
+                mem = MemDisp(size, disp, ctx.scope)
             elif disp:
-                mem = MemBaseDisp(size, base, disp)
+                mem = MemBaseDisp(size, base, disp, ctx.scope)
             else:
-                mem = MemBase(size, base)
+                mem = MemBase(size, base, ctx.scope)
 
             if inst.memory_segment != Register.DS:
                 mem.segment = REG_TO_STRING[inst.memory_segment]
@@ -669,16 +688,17 @@ class I:
         self.no_effects = False
         self.expr = None
 
-    def from_inst(inst, state):
+    def from_inst(inst, state, ctx):
+        formatter = ctx.formatter
         mnemonic = formatter.format_mnemonic(inst)
-        info = info_factory.info(inst)
-        operands = [process_operand(inst, info, i, state) for i in range(formatter.operand_count(inst))]
+        info = ctx.info_factory.info(inst)
+        operands = [process_operand(inst, info, i, state, ctx) for i in range(formatter.operand_count(inst))]
 
         ir = I(mnemonic, operands, inst)
         match inst.mnemonic:
             case M.JA | M.JAE | M.JB | M.JBE | M.JE | M.JG | M.JGE | M.JL | \
               M.JLE | M.JNE | M.JNO | M.JNP | M.JNS | M.JO | M.JP | M.JS:
-                return JCond(inst, state)
+                return JCond(inst, state, ctx)
             case M.CALL:
                 this_expr = state.reg.get(Register.ECX)
                 state.clear()
@@ -739,6 +759,7 @@ class I:
             if self.inst.mnemonic == M.JMP:
                 return False
             return True
+        _, info_factory = tools()
         info = info_factory.info(self.inst)
         for mem in info.used_memory():
             if mem.segment == Register.SS and self.stack_compensate:
@@ -764,6 +785,7 @@ class I:
         return (self.operands,)
 
     def as_code(self):
+        formatter, _ = tools()
         ops = []
         for i, op in enumerate(self.ops()):
             if isinstance(op, str):
@@ -781,17 +803,12 @@ class I:
 
 
 
-def as_asm(data, addr, _scope):
-    global scope
-    scope = _scope
+def as_asm(insts, scope):
+    ctx = LiftContext(scope)
+    formatter = ctx.formatter
 
     s = ""
-    decoder = Decoder(32, data, ip=addr)
-    inst = Instruction.create(Code.INVALID)
-
-    while decoder.can_decode:
-        decoder.decode_out(inst)
-
+    for inst in insts:
         mnemonic = formatter.format_mnemonic(inst)
 
         op_count = formatter.operand_count(inst)
@@ -803,7 +820,7 @@ def as_asm(data, addr, _scope):
         for i in range(formatter.operand_count(inst)):
             opnd = formatter.get_instruction_operand(inst, i)
             if opnd is not None and inst.op_kind(opnd) != OpKind.REGISTER:
-                op = process_operand(inst, None, i, None)
+                op = process_operand(inst, None, i, None, ctx)
                 if isinstance(op, str):
                     ops.append(op)
                     continue
@@ -845,11 +862,6 @@ class State:
         self.stack.append(expr)
 
 
-def set_scope(_scope):
-    global scope
-    scope = _scope
-
-
 class Cond(Expression):
     def __init__(self, cond, left, right = None):
         self.cond = cond
@@ -885,10 +897,11 @@ class ErrorCond(Expression):
 
 class JCond(I):
     __match_args__ = ("cond", "target")
-    def __init__(self, inst: Instruction, state: State):
+    def __init__(self, inst: Instruction, state: State, ctx: LiftContext):
+        formatter = ctx.formatter
         self.inst = inst
         addr = inst.near_branch32
-        self.target = scope.code_ref(inst.ip32, addr) or formatter.format_operand(inst, 0)
+        self.target = ctx.scope.code_ref(inst.ip32, addr) or formatter.format_operand(inst, 0)
         self.operands = self.target
         cmp = state.flags
         self.mnenomic = formatter.format_mnemonic(inst)
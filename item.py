@@ -4,9 +4,58 @@ from gsi import Visablity
 import codeview
 import pydemangler
 import construct
+from array import array
+from bisect import bisect_right
 
 import tpi
 
+class ItemIndex:
+    """
+    Every item with a non-zero length, sorted by address so lookups can bisect.
+    Items are added while modules are still being processed, so the arrays are kept sorted on insert.
+    """
+    def __init__(self):
+        self.items = []
+        self.starts = array('I')
+        self.ends = array('I')
+        # the largest end of any item up to this index, lets find() cope with overlaps
+        self.maxends = array('I')
+
+    def add(self, item):
+        if not item.length:
+            return
+        start, end = item.address, item.address + item.length
+        i = bisect_right(self.starts, start)
+        self.items.insert(i, item)
+        self.starts.insert(i, start)
+        self.ends.insert(i, end)
+        self.maxends.insert(i, max(end, self.maxends[i - 1]) if i else end)
+
+        # Items rarely overlap, so this almost always stops at the next item
+        maxends = self.maxends
+        for j in range(i + 1, len(maxends)):
+            if maxends[j] >= end:
+                break
+            maxends[j] = end
+
+    def find(self, addr):
+        """
+        Returns the item which covers addr, None if there isn't one
+        If several do, the one starting last wins
+        """
+        i = bisect_right(self.starts, addr) - 1
+        while i >= 0 and self.maxends[i] > addr:
+            if self.ends[i] > addr:
+                return self.items[i]
+            i -= 1
+        return None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
 class Item:
     sym = None
     export = None
@@ -4,22 +4,13 @@
 
 from construct import *
 from constructutils import *
+from neoconstruct import struct
 
-import os
+import os, sys, mmap, bisect
+from array import array
 
-class SuperblockSmall(ConstructClass):
-    # Small pages version of the MSF superblock, with 16bit page offsets (used until version 7)
-
-    subcon = Struct(
-        "FileMagic" / Const(b"Microsoft C/C++ program database 2.00\r\n\032JG\0\0"), # 0x2c bytes
-        "BlockSize" / Hex(Int32ul),
-        "FreeBlockMapBlock" / Int16ul, # Can only be 1 or 2
-        "NumBlocks" / Hex(Int16ul),
-        "NumDirectoryBytes" / Hex(Int32ul),
-        "Unknown" / Hex(Int32ul),
-        "NumDirectoryBlocks" / Computed((this.NumDirectoryBytes + this.BlockSize - 1) // this.BlockSize),
-        "BlockMap" / Array(this.NumDirectoryBlocks, Hex(Int16ul)),
-    )
+class Superblock:
+    __slots__ = ()
 
     def __str__(self):
          return f"""Superblock:
@@ -28,59 +19,164 @@ class SuperblockSmall(ConstructClass):
     NumBlocks: {self.NumBlocks}
     NumDirectoryBytes: {self.NumDirectoryBytes}
     Unknown: {self.Unknown}
-    BlockMap: {self.BlockMap} {self.BlockMap[0] * self.BlockSize:x}
+    BlockMap: {list(self.BlockMap)} {self.BlockMap[0] * self.BlockSize:x}
     """
 
+@struct
+class SuperblockSmall(Superblock):
+    # Small pages version of the MSF superblock, with 16bit page offsets (used until version 7)
+
+    FileMagic: Const(b"Microsoft C/C++ program database 2.00\r\n\032JG\0\0") # 0x2c bytes
+    BlockSize: Hex(Int32ul)
+    FreeBlockMapBlock: Int16ul # Can only be 1 or 2
+    NumBlocks: Hex(Int16ul)
+    NumDirectoryBytes: Hex(Int32ul)
+    Unknown: Hex(Int32ul)
+    NumDirectoryBlocks: Computed((this.NumDirectoryBytes + this.BlockSize - 1) // this.BlockSize)
+    BlockMap: Array(this.NumDirectoryBlocks, Hex(Int16ul))
+
+    def parsed(self, ctx):
+        self.BlockMap = array('I', self.BlockMap)
+
+class BlockMapPointer:
+    # The big superblock only has the block number of the directory's block map, ctx.read fetches it
+    @staticmethod
+    def neo_parse(sb, buf, off, end, ctx):
+        data = ctx.read(sb.BlockMapAddr * sb.BlockSize, sb.NumDirectoryBlocks * 4)
+        return le_array('I', data), off
+
+@struct
+class SuperblockBig(Superblock):
+    # MSF 7.00 superblock (aka "big MSF"), with 32bit block numbers.
+    # The list of directory blocks no longer fits in the superblock, so it's stored in its own block
+    # and the superblock just points to it.
+
+    FileMagic: Const(b"Microsoft C/C++ MSF 7.00\r\n\032DS\0\0\0") # 0x20 bytes
+    BlockSize: Hex(Int32ul)
+    FreeBlockMapBlock: Int32ul
+    NumBlocks: Hex(Int32ul)
+    NumDirectoryBytes: Hex(Int32ul)
+    Unknown: Hex(Int32ul)
+    BlockMapAddr: Hex(Int32ul) # block number of the block map
+    NumDirectoryBlocks: Computed((this.NumDirectoryBytes + this.BlockSize - 1) // this.BlockSize)
+    BlockMap: BlockMapPointer
+
+# The superblock is always within the first block, which is at most this big
+SUPERBLOCK_READ_SIZE = 0x1000
+
+def le_array(typecode, data):
+    # Blocks maps can be huge, so store them as packed arrays rather than lists of ints
+    arr = array(typecode)
+    arr.frombytes(data)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr
+
+# Largest single read() issued by a file backed MsfStream
+MAX_RUN_SIZE = 1 << 20
+
+def plan_reads(blocks, block_size, size, max_run_size=MAX_RUN_SIZE):
+    """
+    Merge runs of adjacent block numbers, so a stream can be read with as few read() calls as possible.
+    Returns a list of (stream_offset, file_offset, length) runs covering the whole stream.
+    """
+    runs = []
+    pos = 0
+    for block in blocks:
+        length = min(block_size, size - pos)
+        if length <= 0:
+            break
+        file_offset = block * block_size
+        if runs:
+            run_start, run_offset, run_length = runs[-1]
+            if run_offset + run_length == file_offset and (max_run_size is None or run_length + length <= max_run_size):
+                runs[-1] = (run_start, run_offset, run_length + length)
+                pos += length
+                continue
+        runs.append((pos, file_offset, length))
+        pos += length
+    return runs
+
 class MsfStream():
     def __init__(self, fd, size, block_size, blocks):
         self.fd = fd
         self.size = size
         self.block_size = block_size
         self.blocks = blocks
+        self.runs = plan_reads(blocks, block_size, size)
+        self.run_starts = [start for start, _, _ in self.runs]
+        self.run = None # index of the run currently held in self.data
+        self.data = b""
+        self.data_pos = 0
         self.pos = 0
-        self.do_seek()
+
+    def find_run(self, pos):
+        return bisect.bisect_right(self.run_starts, pos) - 1
 
     def do_seek(self):
+        # self.data holds the current run, self.data_pos is the current position within it
+        if self.run is not None:
+            run_start = self.run_starts[self.run]
+            if run_start <= self.pos < run_start + len(self.data):
+                # still inside the run we already have, no need to touch the file
+                self.data_pos = self.pos - run_start
+                return
+
         if self.pos >= self.size:
+            self.run = None
             self.data = b""
+            self.data_pos = 0
             return
 
-        block_idx = self.pos // self.block_size
-        block_offset = self.pos % self.block_size
-        block = self.blocks[block_idx]
-        self.fd.seek(block * self.block_size)
-        self.data = self.fd.read(self.block_size)
+        self.run = self.find_run(self.pos)
+        run_start, file_offset, length = self.runs[self.run]
+        self.fd.seek(file_offset)
+        self.data = self.fd.read(length)
+        self.data_pos = self.pos - run_start
 
-        if block_idx == len(self.blocks) - 1 and self.size % self.block_size != 0:
-            # trim last block
-            self.data = self.data[:self.size % self.block_size]
+        self.prefetch(self.run + 1)
 
-        if block_offset > 0:
-            self.data = self.data[block_offset:]
+    def prefetch(self, run):
+        # Ask the OS to start reading the next run, so it's hopefully cached by the time we get there
+        if run >= len(self.runs) or not hasattr(os, "posix_fadvise"):
+            return
+        _, file_offset, length = self.runs[run]
+        try:
+            os.posix_fadvise(self.fd.fileno(), file_offset, length, os.POSIX_FADV_WILLNEED)
+        except (OSError, ValueError):
+            pass
 
     def read(self, size=-1):
-        if size == -1:
-            size = self.size - self.pos
+        if size == -1 or self.pos + size > self.size:
+            size = max(0, self.size - self.pos)
 
         remaining = size
-        data = b""
+        chunks = []
+
+        if self.run is None:
+            # nothing loaded yet
+            self.do_seek()
 
         while remaining > 0:
-            if remaining < len(self.data):
-                self.pos += remaining
-                data += self.data[:remaining]
-                self.data = self.data[remaining:]
-                remaining = 0
-            else:
-                self.pos += len(self.data)
-                remaining -= len(self.data)
-                data += self.data
+            available = len(self.data) - self.data_pos
+            if available <= 0:
+                break
+
+            count = min(remaining, available)
+            chunks.append(self.data[self.data_pos:self.data_pos + count])
+            self.data_pos += count
+            self.pos += count
+            remaining -= count
+
+            if self.data_pos == len(self.data):
                 self.do_seek()
 
-            if self.data == b"":
-                break
+        if len(chunks) == 1:
+            return chunks[0]
+        return b"".join(chunks)
 
-        return data
+    def readview(self, size=-1):
+        return memoryview(self.read(size))
 
     def readable(self):
         return True
@@ -98,6 +194,7 @@ class MsfStream():
             self.pos = self.size + n
         if oldpos != self.pos:
             self.do_seek()
+        return self.pos
 
     def seekable(self):
         return True
@@ -111,6 +208,57 @@ class MsfStream():
     def clone(self):
         return MsfStream(self.fd, self.size, self.block_size, self.blocks)
 
+class MappedMsfStream(MsfStream):
+    """
+    MsfStream backed by a memory mapping of the whole PDB file.
+
+    Reads that stay within physically contiguous blocks are served as memoryview slices of the
+    mapping, only reads that straddle a discontinuity between blocks need to be copied.
+    """
+    def __init__(self, view, size, block_size, blocks):
+        self.view = view
+        self.size = size
+        self.block_size = block_size
+        self.blocks = blocks
+        # There is no read() to amortise, so runs can be as long as they like
+        self.runs = plan_reads(blocks, block_size, size, max_run_size=None)
+        self.run_starts = [start for start, _, _ in self.runs]
+        self.pos = 0
+
+    def do_seek(self):
+        pass
+
+    def chunks(self, size):
+        # Yields memoryviews of the mapping that make up the next size bytes of the stream
+        end = self.pos + size
+
+        while self.pos < end:
+            run_start, file_offset, length = self.runs[self.find_run(self.pos)]
+            start = file_offset + self.pos - run_start
+            count = min(length - (self.pos - run_start), end - self.pos)
+            self.pos += count
+            yield self.view[start:start + count]
+
+    def readview(self, size=-1):
+        if size == -1 or self.pos + size > self.size:
+            size = max(0, self.size - self.pos)
+
+        chunks = list(self.chunks(size))
+        if len(chunks) == 1:
+            return chunks[0]
+        return memoryview(b"".join(chunks))
+
+    def read(self, size=-1):
+        # construct expects real bytes (it calls .decode() on strings), so this always copies once.
+        # Use readview to avoid the copy.
+        if size == -1 or self.pos + size > self.size:
+            size = max(0, self.size - self.pos)
+
+        return b"".join(self.chunks(size))
+
+    def clone(self):
+        return MappedMsfStream(self.view, self.size, self.block_size, self.blocks)
+
 # class SubStream:
 #     def __init__(self, stream, offset, size):
 #         self.stream = stream
@@ -144,15 +292,36 @@ class MsfStream():
 #     def closed(self):
 #         return False
 
-class MsfFile(ConstructClass):
-    subcon = Struct(
-        "superblock" / SuperblockSmall,
-    )
-
-    def parsed(self, ctx):
-        fd = self._stream
-        dir_stream = MsfStream(fd, self.superblock.NumDirectoryBytes, self.superblock.BlockSize, self.superblock.BlockMap)
-        self.directory = StreamDirectory.parse_stream(dir_stream, blocksize = self.superblock.BlockSize, fd = fd)
+class MsfFile:
+    def __init__(self, fd, use_mmap=False):
+        view = None
+        if use_mmap:
+            # Map the whole file, streams will be served directly out of the mapping
+            view = memoryview(mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ))
+            def read(offset, size):
+                return view[offset:offset + size]
+        else:
+            def read(offset, size):
+                fd.seek(offset)
+                return fd.read(size)
+
+        header = read(0, SUPERBLOCK_READ_SIZE)
+        try:
+            self.superblock = SuperblockBig.parse(header, read=read)
+            directory = StreamDirectoryBig
+        except ConstError:
+            self.superblock = SuperblockSmall.parse(header, read=read)
+            directory = StreamDirectory
+
+        if view is not None:
+            dir_stream = MappedMsfStream(view, self.superblock.NumDirectoryBytes, self.superblock.BlockSize, self.superblock.BlockMap)
+        else:
+            dir_stream = MsfStream(fd, self.superblock.NumDirectoryBytes, self.superblock.BlockSize, self.superblock.BlockMap)
+        self.directory = directory.parse_stream(dir_stream, blocksize = self.superblock.BlockSize, fd = fd, view = view)
+
+    @classmethod
+    def parse_stream(cls, fd, use_mmap=False):
+        return cls(fd, use_mmap)
 
     def getStream(self, idx):
         return self.directory.getStream(idx)
@@ -160,39 +329,56 @@ class MsfFile(ConstructClass):
     def __len__(self):
         return self.directory.NumStreams
 
-class StreamDirectory(ConstructClass):
-    subcon = Struct(
-        "NumStreams" / Hex(Int16ul),
-        "Reserved" / Hex(Int16ul),
-        "StreamSizes" / Array(this.NumStreams, Struct(
-            "Size" / Hex(Int32ul),
-            "ReservedPtr" / Hex(Int32ul))
-        ),
-       # "TotalBlocks" / Computed(lambda this: StreamDirectory.countBlocks(this)),
-        "StreamBlocks" / GreedyRange(Int16ul)
-    )
-
-    def countBlocks(ctx):
-        blocksize = ctx._.blocksize
-        sizes = [(x.Size + blocksize - 1) // blocksize for x in ctx.StreamSizes]
-        return sum(sizes)
+@struct
+class StreamDirectory:
+    # Stream directory for small MSF files, 16bit stream count and block numbers
+    __slots__ = ("StreamOffsets", "blocksize", "_fd", "_view")
+
+    NumStreams: Hex(Int16ul)
+    Reserved: Hex(Int16ul)
+    # Pairs of (Size, ReservedPtr), both Int32ul
+    StreamSizes: Bytes(this.NumStreams * 8)
+    # Int16ul block numbers for each stream, in order
+    StreamBlocks: GreedyBytes
 
     def parsed(self, ctx):
-        self.StreamSizes = [x.Size for x in self.StreamSizes]
+        sizes = le_array('I', self.StreamSizes)[::2]
+        blocks = array('I', le_array('H', self.StreamBlocks))
+        self.load_streams(ctx, sizes, blocks)
+
+    def load_streams(self, ctx, sizes, blocks):
+        # Nil streams are marked with a size of -1
+        self.StreamSizes = array('I', (0 if size == 0xffffffff else size for size in sizes))
+        self.StreamBlocks = blocks
         self.blocksize = ctx.blocksize
-        fd = ctx.fd
-
-        blocks = list(self.StreamBlocks)
-        self.Streams = []
+        self._fd = ctx.fd
+        self._view = ctx.view
 
+        # Prefix sum of block counts, stream idx owns StreamBlocks[StreamOffsets[idx]:StreamOffsets[idx+1]]
+        self.StreamOffsets = offsets = array('I', [0])
+        total = 0
         for size in self.StreamSizes:
-            count = (size + self.blocksize - 1) // self.blocksize
-            stream_blocks = blocks[:count]
-            blocks = blocks[count:]
-            #print(f"idx: {len(self.Streams):x}, stream size {size}, count {count}, blocks {stream_blocks}")
-            self.Streams.append(MsfStream(fd, size, self.blocksize, stream_blocks))
+            total += (size + self.blocksize - 1) // self.blocksize
+            offsets.append(total)
 
-        assert len(blocks) == 0
+        assert total == len(blocks)
 
     def getStream(self, idx):
-        return self.Streams[idx]
+        # Streams are only created on demand, each call returns a new stream positioned at the start
+        size = self.StreamSizes[idx]
+        blocks = memoryview(self.StreamBlocks)[self.StreamOffsets[idx]:self.StreamOffsets[idx + 1]]
+        if self._view is not None:
+            return MappedMsfStream(self._view, size, self.blocksize, blocks)
+        return MsfStream(self._fd, size, self.blocksize, blocks)
+
+@struct
+class StreamDirectoryBig(StreamDirectory):
+    # Stream directory for big MSF files, everything is 32bit
+    NumStreams: Hex(Int32ul)
+    StreamSizes: Bytes(this.NumStreams * 4)
+    StreamBlocks: GreedyBytes
+
+    def parsed(self, ctx):
+        sizes = le_array('I', self.StreamSizes)
+        blocks = le_array('I', self.StreamBlocks)
+        self.load_streams(ctx, sizes, blocks)
@@ -1,12 +1,37 @@
-
 """
-A wrapper around construct that allows for a more object oriented approach to defining structures.
+A compiled, slots based alternative to construct, for the structures we parse millions of times.
+
+Structures are declared as classes, with construct subcons as annotations:
+
+    @struct
+    class Example:
+        a: Int32ul
+        b: Int16ul
+        _pad: Padding(2)
+        name: PascalString(Int8ul, "ascii")
+
+@struct compiles a parse function specialised to the class, which works directly on a buffer with
+a moving offset. Runs of fixed size fields are decoded with a single struct.unpack_from, strings
+and bytes are sliced out of the buffer, and the results are stored in __slots__.
+Fields starting with _ are parsed but not stored.
+
+Subcons the compiler doesn't know about are handed to construct, so anything still works,
+just without the speedup.
+
+Field types can also implement the compiler's protocol themselves, with either:
+    neo_format: a struct format string, plus neo_decode(value, ctx) to convert the unpacked value
+    neo_parse(obj, buf, off, end, ctx): returns (value, new offset), obj holds the previous fields
+
+Unlike construct objects, _addr is the offset within the buffer passed to parse_from.
+Methods of @struct classes can't use zero argument super(), as the class is rebuilt with __slots__.
 """
 
-import inspect, ast, textwrap, tokenize, io, re, copy, types, functools
+import inspect, ast, textwrap, tokenize, io, re, types, functools
 from io import BytesIO
+from struct import Struct, unpack_from
 
 import construct as cs
+from constructutils import Dec, str_value
 
 def _parse_doccomment(str, before):
     """Parses Spinx style doc comments (prefixed with #:)
@@ -14,14 +39,18 @@ def _parse_doccomment(str, before):
         before: if True, the line must only contain the doc comment
     """
     io = BytesIO(str.encode('utf-8'))
-    for tok in tokenize.tokenize(io.readline):
-        if tok.type == tokenize.ENCODING:
-            continue
-        if tok.type == tokenize.COMMENT and tok.string.startswith("#:"):
-            return tok.string[2:].strip()
-        if before:
-            # We found something that wasn't a comment
-            return None
+    try:
+        for tok in tokenize.tokenize(io.readline):
+            if tok.type == tokenize.ENCODING:
+                continue
+            if tok.type == tokenize.COMMENT and tok.string.startswith("#:"):
+                return tok.string[2:].strip()
+            if before:
+                # We found something that wasn't a comment
+                return None
+    except tokenize.TokenError:
+        # Part of a statement which spans multiple lines
+        pass
     return None
 
 def _get_attribute_docs(cls):
@@ -30,7 +59,7 @@ def _get_attribute_docs(cls):
 
     try:
         src = inspect.getsource(cls)
-    except OSError:
+    except (OSError, TypeError):
         return docs
 
     tree = ast.parse(textwrap.dedent(src))
@@ -77,132 +106,376 @@ def hybrid_classmethod(func):
 
     return HybridDescriptor(func)
 
-class NeoConstruct(object):
+def context(**contextkw):
+    """The context passed down to parse_from, holds the keyword arguments of parse()"""
+    ctx = cs.Container(contextkw)
+    ctx._parsing = True
+    ctx._building = False
+    ctx._sizing = False
+    ctx._params = ctx
+    return ctx
+
+class NeoStruct:
+    __slots__ = ("_addr", "_size")
+
+    #: (name, subcon) of every field, in order
+    fields = ()
+    #: names of the stored fields
+    names = ()
+    #: name -> (offset, size) for the fields at a fixed offset
+    offsets = {}
+    #: None if the size depends on the data
+    fixed_size = None
+    short_name = "Neo"
+
     @classmethod
-    def _parsereport(cls, stream, context, path):
-        obj = cls._parse(stream, context, path)
-        return obj
+    def parse_from(cls, buf, off=0, end=None, ctx=None):
+        """Parses an object at buf[off:end], returns (obj, offset after it). Replaced by @struct"""
+        raise NotImplementedError(f"{cls.__name__} isn't a @struct")
 
+    @classmethod
+    def parse_array(cls, buf, off=0, end=None, ctx=None):
+        """Parses consecutive objects which exactly fill buf[off:end]"""
+        if end is None:
+            end = len(buf)
+        if ctx is None:
+            ctx = context()
+        parse = cls.parse_from
+        objs = []
+        while off < end:
+            obj, off = parse(buf, off, end, ctx)
+            objs.append(obj)
+        if off != end:
+            raise cs.StreamError(f"{cls.__name__} array overran its end by {off - end} bytes")
+        return objs
 
     @classmethod
     def parse(cls, data, **contextkw):
-        return cls.parse_stream(BytesIO(data), **contextkw)
+        return cls.parse_from(data, 0, len(data), context(**contextkw))[0]
 
     @classmethod
     def parse_stream(cls, stream, **contextkw):
-        r"""
-        Parse a stream. Files, pipes, sockets, and other streaming sources of data are handled by this method. See parse().
-        """
-        context = Container(**contextkw)
-        context._parsing = True
-        context._building = False
-        context._sizing = False
-        context._params = context
-        try:
-            return cls._parsereport(stream, context, "(parsing)")
-        except CancelParsing:
-            pass
-
-
-class NeoStruct(NeoConstruct):
-    @classmethod
-    def _parse(cls, stream, context, path):
-        obj = cls.__new__(cls)
-
-        for sc in cls.subcons:
-            val = sc._parsereport(stream, context, path)
-            if sc.name:
-                setattr(obj, sc.name, val)
-                context[sc.name] = val
-
+        # Streams are read from the start, so _addr is the offset within the stream
+        start = stream.tell()
+        stream.seek(0)
+        data = stream.read(-1 if cls.fixed_size is None else start + cls.fixed_size)
+        obj, off = cls.parse_from(data, start, len(data), context(**contextkw))
+        stream.seek(off)
         return obj
 
+    def parsed(self, ctx):
+        pass
+
     @hybrid_classmethod
     def sizeof(cls, self):
-        print(f"sizeof {cls}, {self}")
-
-
-class NeoObject:
-    pass
-
-def _process_struct(cls, **kwargs):
-    if 'short_name' in kwargs:
-        cls.short_name = kwargs.pop("short_name")
-    else:
-        cls.short_name = re.sub('[a-z]', '', cls.__name__)
-        if len(cls.short_name) > 5:
-            cls.short_name = cls.short_name[:3] + cls.short_name[-2:]
-
-    cls_annotations = inspect.get_annotations(cls)
-    docsstrings = _get_attribute_docs(cls)
-    cls_dict = object.__getattribute__(cls, "__dict__")
-
-    # Collect struct fields
-    subcons = []
-    for name, ann in cls_annotations.items():
-        if not isinstance(ann, cs.Construct) or ann is cs.Construct:
-            continue
-
-        subcon = ann
-
-        default_value = cls_dict.get(name, None)
-        if isinstance(default_value, cs.Construct):
-            raise ValueError(f"default value for {name} should not be a Construct")
-
-        if default_value:
-            subcon = Default(subcon, default_value)
-
-        doc = docsstrings.get(name, None)
-        subcons.append(cs.Renamed(subcon, newname=name, newdocs=doc))
+        if self is not None:
+            return self._size
+        if cls.fixed_size is None:
+            raise cs.SizeofError(f"{cls.__name__} doesn't have a fixed size")
+        return cls.fixed_size
+
+    def __getitem__(self, name):
+        # So construct's this expressions work on us
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def items(self):
+        for name in self.names:
+            try:
+                yield name, getattr(self, name)
+            except AttributeError:
+                pass
+
+    def __str__(self):
+        str = self.__class__.__name__
+        if getattr(self, "_addr", None) is not None:
+            str += f" @ 0x{self._addr:x}:"
+        str += "\n"
+
+        for key, value in self.items():
+            off = ""
+            if key in self.offsets:
+                offv, sizeof = self.offsets[key]
+                off = f"\x1b[32m[{offv:3x}.{sizeof:3x}]\x1b[m "
+            val_repr = str_value(value)
+            if '\n' in val_repr:
+                val_repr = textwrap.indent(val_repr, f'\x1b[90m{self.short_name:>5s}.\x1b[m')
+                if not val_repr.endswith('\n'):
+                    val_repr += '\n'
+                str += f"\x1b[90m{self.short_name:>5s}.{off}\x1b[95m{key}\x1b[m =\n{val_repr}"
+            else:
+                str += f"\x1b[90m{self.short_name:>5s}.{off}\x1b[95m{key}\x1b[m = {val_repr}\n"
+
+        return str
+
+class Substream:
+    """size bytes (an expression of the previous fields) filled with back to back `subcon`s"""
+    def __init__(self, size, subcon):
+        self.size = size
+        self.subcon = subcon
+
+    def neo_parse(self, obj, buf, off, end, ctx):
+        end = off + cs.evaluate(self.size, obj)
+        return self.subcon.parse_array(buf, off, end, ctx), end
+
+def _fallback(subcon, obj, names, buf, off, end, ctx):
+    # construct gets a copy of the rest of the buffer, and a context with the fields so far
+    stream = BytesIO(bytes(buf[off:end]))
+    c = cs.Container()
+    for name in names:
+        try:
+            c[name] = getattr(obj, name)
+        except AttributeError:
+            pass
+    c._ = ctx
+    c._params = ctx._params
+    c._root = ctx
+    c._parsing = True
+    c._building = False
+    c._sizing = False
+    c._io = stream
+    c._index = None
+    c._subcons = None
+    return subcon._parsereport(stream, c, "(parsing)"), off + stream.tell()
+
+def _unwrap(subcon):
+    # Display adapters and renames don't change what's parsed
+    while type(subcon) in (cs.Hex, cs.HexDump, Dec, cs.Renamed):
+        subcon = subcon.subcon
+    return subcon
+
+def _format(subcon):
+    # struct format for subcons which unpack to exactly one value (or nothing for padding)
+    if isinstance(subcon, cs.FormatField):
+        if subcon.fmtstr[0] == "<" or subcon.fmtstr[1:] in ("B", "b"):
+            return subcon.fmtstr[1:]
+        return None
+    if type(subcon) is cs.Bytes and isinstance(subcon.length, int):
+        return f"{subcon.length}s"
+    if type(subcon) is cs.Padded and subcon.subcon is cs.Pass and isinstance(subcon.length, int):
+        return f"{subcon.length}x"
+    return None
 
-    for name, value in cls_dict.items():
-        if name in cls_annotations or name.startswith("__") or inspect.isfunction(value):
-            continue
-        if isinstance(value, cs.Construct):
-            raise ValueError(f"Attempting to assign the Construct {value} to {attr}. Use `name: {value}` instead (or use an explicit type annotation of Construct to suppress this error)")
+def _is_field(ann):
+    if isinstance(ann, type) and issubclass(ann, NeoStruct):
+        return True
+    return isinstance(ann, cs.Construct) or hasattr(ann, "neo_parse") or hasattr(ann, "neo_format")
+
+def _compile(cls, fields, align):
+    env = { "new": object.__new__, "evaluate": cs.evaluate, "fallback": _fallback,
+            "ConstError": cs.ConstError, "StreamError": cs.StreamError,
+            "unpack_from": unpack_from, "context": context }
+    lines = [
+        "def parse_from(cls, buf, off=0, end=None, ctx=None):",
+        "    if end is None:",
+        "        end = len(buf)",
+        "    if ctx is None:",
+        "        ctx = context()",
+        "    self = new(cls)",
+        "    self._addr = start = off",
+    ]
+
+    def emit(line):
+        lines.append("    " + line)
+
+    def const(obj):
+        name = f"_k{len(env)}"
+        env[name] = obj
+        return name
 
-    # calculate sizes/offsets
     offsets = {}
-
-    off = 0
-    for subcon in subcons:
-        size = subcon.sizeof()
-        if size is None:
-            size = FuncPath(lambda obj: obj.sizeof())
-
-        offsets[subcon] = off, size
-        off = size + off
-
-    cls.subcons = subcons
-    cls.offsets = offsets
-
-    # Add NeoStruct as base class
-    cls = type(cls.__name__, (NeoStruct, cls), {})
-
-    return cls
+    static = 0 # offset of the current field, while it doesn't depend on the data
+    group = [] # (format, target, code to run after unpacking) of fields to unpack together
+    stored = []
+
+    def flush():
+        if not group:
+            return
+        s = Struct("<" + "".join(fmt for fmt, _, _ in group))
+        targets = [target for fmt, target, _ in group if not fmt.endswith("x")]
+        if targets:
+            emit(f"{', '.join(targets)}, = {const(s.unpack_from)}(buf, off)")
+        for _, _, after in group:
+            if after:
+                emit(after)
+        emit(f"off += {s.size}")
+        group.clear()
+
+    for i, (name, subcon) in enumerate(fields):
+        target = f"self.{name}" if not name.startswith("_") else f"_v{i}"
+        subcon = _unwrap(subcon)
+        size = None
+
+        if hasattr(subcon, "neo_format"):
+            tmp = f"_v{i}"
+            group.append((subcon.neo_format, tmp, f"{target} = {const(subcon.neo_decode)}({tmp}, ctx)"))
+            size = Struct("<" + subcon.neo_format).size
+        elif (fmt := _format(subcon)) is not None:
+            group.append((fmt, target, None))
+            size = Struct("<" + fmt).size
+        elif type(subcon) is cs.Const and (fmt := _format(subcon.subcon)) is not None:
+            value = const(subcon.value)
+            group.append((fmt, target, f"if {target} != {value}: raise ConstError(f'parsing expected {{{value}!r}} but parsed {{{target}!r}} for {cls.__name__}.{name}')"))
+            size = Struct("<" + fmt).size
+        else:
+            flush()
+            if isinstance(subcon, type) and issubclass(subcon, NeoStruct):
+                emit(f"{target}, off = {const(subcon.parse_from)}(buf, off, end, ctx)")
+                size = subcon.fixed_size
+            elif hasattr(subcon, "neo_parse"):
+                emit(f"{target}, off = {const(subcon.neo_parse)}(self, buf, off, end, ctx)")
+            elif type(subcon) is cs.StringEncoded and type(subcon.subcon) is cs.Prefixed \
+                    and subcon.subcon.subcon is cs.GreedyBytes and _format(subcon.subcon.lengthfield):
+                fmt = _format(subcon.subcon.lengthfield)
+                if fmt == "B":
+                    emit("n = buf[off]")
+                else:
+                    emit(f"n, = {const(Struct('<' + fmt).unpack_from)}(buf, off)")
+                emit(f"off += {Struct('<' + fmt).size}")
+                emit(f"{target} = str(buf[off:off + n], {subcon.encoding!r})")
+                emit("off += n")
+            elif type(subcon) is cs.StringEncoded and type(subcon.subcon) is cs.NullTerminated \
+                    and subcon.subcon.subcon is cs.GreedyBytes and subcon.subcon.term == b"\0":
+                # needs buf to be bytes, memoryviews don't have index()
+                emit("n = buf.index(0, off)")
+                emit(f"{target} = str(buf[off:n], {subcon.encoding!r})")
+                emit("off = n + 1")
+            elif type(subcon) is cs.Bytes:
+                emit(f"n = evaluate({const(subcon.length)}, self)")
+                emit(f"{target} = bytes(buf[off:off + n])")
+                emit("off += n")
+            elif subcon is cs.GreedyBytes:
+                emit(f"{target} = bytes(buf[off:end])")
+                emit("off = end")
+            elif type(subcon) is cs.Computed:
+                emit(f"{target} = evaluate({const(subcon.func)}, self)")
+                size = 0
+            elif type(subcon) is cs.Array and (fmt := _format(_unwrap(subcon.subcon))) is not None and not fmt.endswith("x"):
+                item = Struct("<" + fmt).size
+                if isinstance(subcon.count, int):
+                    emit(f"{target} = list({const(Struct(f'<{subcon.count}{fmt}').unpack_from)}(buf, off))")
+                    emit(f"off += {subcon.count * item}")
+                    size = subcon.count * item
+                else:
+                    emit(f"n = evaluate({const(subcon.count)}, self)")
+                    emit(f"{target} = list(unpack_from(f'<{{n}}{fmt}', buf, off))")
+                    emit(f"off += n * {item}")
+            elif type(subcon) is cs.Array and isinstance(_unwrap(subcon.subcon), type) \
+                    and issubclass(_unwrap(subcon.subcon), NeoStruct):
+                parse = const(_unwrap(subcon.subcon).parse_from)
+                emit(f"{target} = []")
+                emit(f"for _ in range(evaluate({const(subcon.count)}, self)):")
+                emit(f"    item, off = {parse}(buf, off, end, ctx)")
+                emit(f"    {target}.append(item)")
+            else:
+                emit(f"{target}, off = fallback({const(subcon)}, self, {tuple(stored)!r}, buf, off, end, ctx)")
+
+        if static is not None:
+            if size is None:
+                static = None
+            elif not name.startswith("_"):
+                offsets[name] = (static, size)
+        if static is not None:
+            static += size
+        if not name.startswith("_"):
+            stored.append(name)
+
+    flush()
+    if align:
+        emit(f"off += -(off - start) % {align}")
+        if static is not None:
+            static += -static % align
+    emit("if off > end:")
+    emit(f"    raise StreamError(f'{cls.__name__} overran its end by {{off - end}} bytes')")
+    emit("self._size = off - start")
+    emit("self.parsed(ctx)")
+    emit("return self, off")
+
+    src = "\n".join(lines) + "\n"
+    exec(compile(src, f"<neoconstruct {cls.__qualname__}>", "exec"), env)
+    return classmethod(env["parse_from"]), src, offsets, stored, static
+
+def _process_struct(cls, align=None, dynamic=False, short_name=None):
+    if short_name is None:
+        short_name = re.sub('[a-z]', '', cls.__name__)
+        if len(short_name) > 5:
+            short_name = short_name[:3] + short_name[-2:]
+
+    fields = [(name, ann) for name, ann in inspect.get_annotations(cls).items() if _is_field(ann)]
+
+    cls_dict = dict(cls.__dict__)
+    for name, value in cls_dict.items():
+        if isinstance(value, cs.Construct) and not isinstance(value, type):
+            raise ValueError(f"Attempting to assign the Construct {value} to {name}. Use `{name}: {value}` instead")
+
+    # Rebuild the class with __slots__ for the fields (plus any slots it declared itself)
+    own_slots = cls_dict.pop("__slots__", ())
+    if isinstance(own_slots, str):
+        own_slots = (own_slots,)
+    for name in own_slots:
+        cls_dict.pop(name, None)
+    cls_dict.pop("__dict__", None)
+    cls_dict.pop("__weakref__", None)
+
+    base_slots = set()
+    for base in cls.__mro__[1:]:
+        base_slots.update(base.__dict__.get("__slots__", ()))
+
+    slots = [name for name, _ in fields if not name.startswith("_") and name not in base_slots]
+    slots += [name for name in own_slots if name not in slots and name not in base_slots]
+    if dynamic and "__dict__" not in base_slots:
+        slots.append("__dict__")
+    cls_dict["__slots__"] = tuple(slots)
+
+    bases = cls.__bases__
+    if not issubclass(cls, NeoStruct):
+        bases = tuple(base for base in bases if base is not object) + (NeoStruct,)
+    new_cls = type(cls.__name__, bases, cls_dict)
+
+    parse_from, src, offsets, names, static = _compile(new_cls, fields, align)
+    new_cls.parse_from = parse_from
+    new_cls.parse_source = src
+    new_cls.fields = fields
+    new_cls.names = tuple(names)
+    new_cls.offsets = offsets
+    new_cls.fixed_size = static
+    new_cls.short_name = short_name
+    new_cls.docs = _get_attribute_docs(cls)
+
+    return new_cls
 
 def struct(cls=None, **kwargs):
+    """
+    Compiles a class into a NeoStruct. Options:
+        align: the size is padded to a multiple of this
+        dynamic: instances also get a __dict__, for attributes added after parsing
+        short_name: prefix for __str__
+    """
     def wrap(cls):
         return _process_struct(cls, **kwargs)
 
     if cls is None:
-        return wrapper
+        return wrap
     return wrap(cls)
 
 if __name__ == "__main__":
     # example:
 
-    from construct import *
+    from construct import Int8ul, Int32ul, PascalString
 
     @struct
     class Example:
         #: This is field a. I like it
-        a: Int32ul = 0
+        a: Int32ul
 
         b: Int32ul #: field b is cool too
 
         c = 2 #: this isn't for hhhh
-        hhhh: Int32ul = 3
+        hhhh: PascalString(Int8ul, "ascii")
         """Trailing docstring"""
 
-    e = Example.parse(b"\x55\x00\x00\x00\x44\x00\x00\x00\x66\x00\x00\x00")
\ No newline at end of file
+    e = Example.parse(b"\x55\x00\x00\x00\x44\x00\x00\x00\x03abc")
+    print(e)
+    print(Example.parse_source)
@@ -0,0 +1,139 @@
+"""On disk cache for the slow parts of ProgramData.
+
+   Each stream (TPI, symbol records, GSI/PGSI and every module) gets its own shard.
+   Shards are keyed by a hash of the PDB and EXE, plus the source of only the modules
+   which produce that shard. Editing something like dump.py doesn't invalidate anything,
+   and editing lines.py only rebuilds the module shards.
+
+   Type objects are pickled once, in the TPI shard. Every other shard refers to them by TI.
+"""
+
+import hashlib, os, pickle, sys
+from collections import OrderedDict
+from pathlib import Path
+
+import construct
+
+import base_types
+from tpi import TypeLeaf
+
+def better_getstate(self):
+    ret = OrderedDict(self)
+    try:
+        del ret["_io"]
+    except KeyError:
+        pass
+    try:
+        del ret["_stream"]
+    except KeyError:
+        pass
+
+    return ret
+
+# monkey patch container to filter out all io objects
+construct.Container.__getstate__ = better_getstate
+
+def hash_file(filename):
+    h = hashlib.sha1()
+    with open(filename, "rb") as f:
+        while chunk := f.read(1 << 20):
+            h.update(chunk)
+    return h.digest()
+
+class ShardPickler(pickle.Pickler):
+    def __init__(self, file, types):
+        super().__init__(file, pickle.HIGHEST_PROTOCOL)
+        self.types = types
+
+    def persistent_id(self, obj):
+        if isinstance(obj, base_types.BaseType) and base_types.types[obj.TI] is obj:
+            return ("base", obj.TI)
+
+        types = self.types
+        if types is None:
+            return None
+        if obj is types:
+            return ("types",)
+        if isinstance(obj, TypeLeaf):
+            # Members of field lists share their parent's TI, only the parent is in types
+            try:
+                if types.types[obj.TI] is obj:
+                    return ("TI", obj.TI)
+            except (AttributeError, IndexError):
+                pass
+        return None
+
+class ShardUnpickler(pickle.Unpickler):
+    def __init__(self, file, types):
+        super().__init__(file)
+        self.types = types
+
+    def persistent_load(self, pid):
+        match pid:
+            case ("base", TI):
+                return base_types.types[TI]
+            case ("types",):
+                return self.types
+            case ("TI", TI):
+                return self.types.types[TI]
+        raise pickle.UnpicklingError(f"unknown persistent id {pid}")
+
+class ParseCache:
+    def __init__(self, path, *files):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        h = hashlib.sha1()
+        for file in files:
+            h.update(hash_file(file))
+        self.files_hash = h.digest()
+
+        self.sources = {}
+        # Set once the TPI shard is loaded, all other shards refer to it
+        self.types = None
+
+    def source_hash(self, module):
+        try:
+            return self.sources[module]
+        except KeyError:
+            self.sources[module] = h = hash_file(Path(__file__).parent / f"{module}.py")
+            return h
+
+    def filename(self, name, modules):
+        h = hashlib.sha1(self.files_hash)
+        h.update(name.encode())
+        for module in sorted(modules):
+            h.update(module.encode())
+            h.update(self.source_hash(module))
+        return self.path / f"{name}-{h.hexdigest()[:16]}.pkl"
+
+    def load(self, name, modules):
+        # Raises KeyError if there is no usable shard
+        try:
+            with open(self.filename(name, modules), "rb") as f:
+                return ShardUnpickler(f, self.types).load()
+        except FileNotFoundError:
+            raise KeyError(name)
+        except Exception as e:
+            print(f"Cache shard {name} failed to load because: {e}", file=sys.stderr)
+            raise KeyError(name)
+
+    def store(self, name, modules, obj):
+        filename = self.filename(name, modules)
+
+        # remove stale versions of this shard
+        for old in self.path.glob(f"{name}-*.pkl"):
+            old.unlink()
+
+        tmp = filename.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            ShardPickler(f, self.types).dump(obj)
+        os.replace(tmp, filename)
+
+    def get(self, name, modules, build):
+        try:
+            return self.load(name, modules)
+        except KeyError:
+            obj = build()
+            self.store(name, modules, obj)
+            return obj
@@ -10,39 +10,43 @@ from utils import *
 from msf import *
 
 from codeview import *
+from neoconstruct import struct, Substream, context
 from lines import *
 from tpi import *
 from gsi import Gsi, Pgsi, LoadSymbols, Visablity
 from pathlib import Path
 from intervaltree import Interval, IntervalTree
+from array import array
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+import io
+import pickle
 
 StreamNumT = Int16ul
 
-class DebugInfomationHeader(ConstructClass):
-    subcon = Struct(
-        "GlobalSymbolStream" / StreamNumT,
-        "PublicSymbolStream" / StreamNumT,
-        "SymbolRecordStream" / StreamNumT,
-        Padding(2),
-        "ModuleInfoSize" / Int32ul,
-        "SectionContributionSize" / Int32ul,
-        "SectionMapSize" / Int32ul,
-        "SourceInfoSize" / Int32ul,
-    )
-
-class SectionContrib(ConstructClass):
+@struct
+class DebugInfomationHeader:
+    GlobalSymbolStream: StreamNumT
+    PublicSymbolStream: StreamNumT
+    SymbolRecordStream: StreamNumT
+    _pad: Padding(2)
+    ModuleInfoSize: Int32ul
+    SectionContributionSize: Int32ul
+    SectionMapSize: Int32ul
+    SourceInfoSize: Int32ul
+
+@struct(dynamic=True)
+class SectionContrib:
     # Appears to be struct SC40:
     # https://github.com/microsoft/microsoft-pdb/blob/master/PDB/include/dbicommon.h#L19
-    subcon = Struct(
-        "Section" / Int16ul,
-        "Unknown1" / Int16ul, # Always 0xcbf for valid entries
-        "Offset" / Int32ul,
-        "Size" / Int32ul,
-        # https://learn.microsoft.com/en-us/windows/win32/api/winnt/ns-winnt-image_section_header
-        "Characteristics" / Hex(Int32ul),
-        "ModuleIndex" / Int16ul,
-        "Pad2" / Int16ul,
-    )
+    Section: Int16ul
+    Unknown1: Int16ul # Always 0xcbf for valid entries
+    Offset: Int32ul
+    Size: Int32ul
+    # https://learn.microsoft.com/en-us/windows/win32/api/winnt/ns-winnt-image_section_header
+    Characteristics: Hex(Int32ul)
+    ModuleIndex: Int16ul
+    Pad2: Int16ul
 
     def parsed(self, ctx):
         self.symbols = []
@@ -100,6 +104,7 @@ class SectionContrib(ConstructClass):
 
 
 class SectionMapEntry(ConstructClass):
+    compiled_parse = True
     subcon = Struct(
         "Flags" / Int16ul,
         "Overlay" / Int16ul, # Logical overlay number
@@ -152,55 +157,83 @@ class SourceInfo(ConstructClass):
         del self.FilenameOffsets
         del self.NamesBuffer
 
-class ModuleInfo(ConstructClass):
+@struct(align=4, dynamic=True)
+class ModuleInfo:
     # immediately follows header
-    subcon = Aligned(4, Struct(
-        "Unused" / Int32ul, # Currently open module?
-        # Appears to be a copy of the last Section Contribution for this module.
-        # which makes it kind of useless
-        "SectionContrib" / SectionContrib,
-        "Flags" / Int16ul,
-        "Stream" / StreamNumT,
-        "SymbolsSize" / Int32ul,
-        "LinesSize" / Int32ul,
-        "FramePointerOptSize" / Int32ul,
-        "SourceFileCount" / Int16ul,
-        Padding(2),
-        #"pad" / Int16ul,
-        "SourceFilenameIndex" / Int32ul,
-        "ModuleName" / CString("ascii"), # name of the .obj file
-        # When the .obj file was directly linked into the exe: ObjFilename == ModuleName
-        # Otherwise, ObjFilename is the library it was previously linked into
-        "ObjFilename" / CString("ascii"),
-    ))
-
-    def parsed(self, ctx):
-        pass
-        #print(f"ModuleInfo: {self.ModuleName} {self.ObjFilename} {self.Stream} {self.SymbolsSize} {self.LinesSize} {self.FramePointerOptSize} {self.SourceFileCount} {self.SourceFilenameIndex} {self.SectionContrib}")
-
-
-class DebugInfomation(ConstructClass):
-    subcon = Struct(
-        "Header" / DebugInfomationHeader,
-        "ModuleInfo" / FixedSized(this.Header.ModuleInfoSize,
-           RepeatUntil(lambda x, lst, ctx: x._io.tell() == DebugInfomationHeader.sizeof() + ctx.Header.ModuleInfoSize,
-           ModuleInfo
-        )),
-        "SectionContribution" / FixedSized(this.Header.SectionContributionSize,
-            RepeatUntil(lambda x, lst, ctx: x._io.tell() == DebugInfomationHeader.sizeof() + ctx.Header.ModuleInfoSize + ctx.Header.SectionContributionSize,
-            SectionContrib)
-        ),
-        "SectionMap" / FixedSized(this.Header.SectionMapSize, SectionMap),
-        "SourceInfo" / FixedSized(this.Header.SourceInfoSize, SourceInfo),
-    )
-
-    def parsed(self, ctx):
-        # contents of substreams should fill the stream
-        dbi = self.Header
-        size = dbi.ModuleInfoSize + dbi.SectionContributionSize + dbi.SectionMapSize + dbi.SourceInfoSize
-        assert len(self.SectionContribution * SectionContrib.sizeof()) == dbi.SectionContributionSize
-        assert size + DebugInfomationHeader.sizeof() == self._stream.size
-
+    Unused: Int32ul # Currently open module?
+    # Appears to be a copy of the last Section Contribution for this module.
+    # which makes it kind of useless
+    SectionContrib: SectionContrib
+    Flags: Int16ul
+    Stream: StreamNumT
+    SymbolsSize: Int32ul
+    LinesSize: Int32ul
+    FramePointerOptSize: Int32ul
+    SourceFileCount: Int16ul
+    _pad: Padding(2)
+    SourceFilenameIndex: Int32ul
+    ModuleName: CString("ascii") # name of the .obj file
+    # When the .obj file was directly linked into the exe: ObjFilename == ModuleName
+    # Otherwise, ObjFilename is the library it was previously linked into
+    ObjFilename: CString("ascii")
+
+
+@struct
+class DebugInfomation:
+    Header: DebugInfomationHeader
+    ModuleInfo: Substream(this.Header.ModuleInfoSize, ModuleInfo)
+    SectionContribution: Substream(this.Header.SectionContributionSize, SectionContrib)
+    SectionMap: FixedSized(this.Header.SectionMapSize, SectionMap)
+    SourceInfo: FixedSized(this.Header.SourceInfoSize, SourceInfo)
+    # contents of substreams should fill the stream
+    _end: Terminated
+
+
+class ContribIndex:
+    """
+    The section contributions of a single section, sorted by offset so lookups can bisect.
+    Zero sized contributions cover a single byte, like they did in the IntervalTree this replaces.
+    """
+    def __init__(self):
+        self.contribs = []
+        self.starts = array('I')
+        self.ends = array('I')
+        # the largest end of any contrib up to this index, lets find() cope with overlaps
+        self.maxends = array('I')
+
+    def build(self, contribs):
+        self.contribs = sorted(contribs, key=lambda sc: sc.Offset)
+        self.starts = array('I', (sc.Offset for sc in self.contribs))
+        self.ends = array('I', (sc.Offset + max(1, sc.Size) for sc in self.contribs))
+        self.maxends = array('I')
+        maxend = 0
+        for end in self.ends:
+            maxend = max(maxend, end)
+            self.maxends.append(maxend)
+
+    def find(self, start, end=None, module=None, sized=False):
+        """
+        Returns the contribution which overlaps offset start (or the range start:end), None if there isn't one
+        If several do, the one starting last wins
+        With module, only contributions from that module are considered, and with sized zero sized ones are skipped,
+        so they can't shadow the one that was asked for.
+        """
+        if end is None:
+            end = start + 1
+        i = bisect_right(self.starts, end - 1) - 1
+        while i >= 0 and self.maxends[i] > start:
+            if self.ends[i] > start:
+                contrib = self.contribs[i]
+                if (module is None or contrib.module is module) and (not sized or contrib.Size):
+                    return contrib
+            i -= 1
+        return None
+
+    def __iter__(self):
+        return iter(self.contribs)
+
+    def __len__(self):
+        return len(self.contribs)
 
 class Section:
     def __init__(self, idx, section):
@@ -211,15 +244,78 @@ class Section:
             self.data = section.Data
         else:
             self.va = None
-        self.contribs = IntervalTree()
+        self.contribs = ContribIndex()
+
+def parse_module_stream(data, symbols_size, lines_size, types):
+    # Returns the symbol tree and lines of a module stream
+    if data is None:
+        return None, None
+
+    symbols = None
+    if symbols_size:
+        # The records follow a 4 byte signature
+        records = CodeviewRecord.parse_array(data, 4, symbols_size, context(types=types))
+        symbols = toTree(records)
+
+    lines = None
+    if lines_size:
+        lines = LinesSection.parse(data[symbols_size:symbols_size + lines_size], types=types)
+
+    return symbols, lines
+
+class TypeStub:
+    # Stands in for a type while a module is parsed in a worker process.
+    # They are swapped for the real types when the results are unpickled by load_module_result
+    __slots__ = ("TI",)
+
+    def __init__(self, TI):
+        self.TI = TI
+
+class TypeStubs:
+    # TypeRef only ever looks up types.types[TI]
+    def __init__(self):
+        self.types = self
+
+    def __getitem__(self, TI):
+        return TypeStub(TI)
+
+class ModulePickler(pickle.Pickler):
+    def persistent_id(self, obj):
+        if type(obj) is TypeStub:
+            return obj.TI
+        return None
+
+class ModuleUnpickler(pickle.Unpickler):
+    def __init__(self, file, types):
+        super().__init__(file)
+        self.types = types
+
+    def persistent_load(self, TI):
+        return self.types.types[TI]
+
+def parse_module_worker(job):
+    data, symbols_size, lines_size = job
+    result = parse_module_stream(data, symbols_size, lines_size, TypeStubs())
+    f = io.BytesIO()
+    ModulePickler(f, pickle.HIGHEST_PROTOCOL).dump(result)
+    return f.getvalue()
+
+def load_module_result(result, types):
+    return ModuleUnpickler(io.BytesIO(result), types).load()
+
+# The modules which produce each of the ParseCache shards
+TPI_MODULES = ["tpi", "tpi_fast", "base_types", "varint", "pdbhash", "constructutils", "msf"]
+GSI_MODULES = ["gsi", "pdbhash", "constructutils", "msf"]
+SYMBOL_MODULES = ["gsi", "codeview", "varint", "neoconstruct", "constructutils", "msf"]
+MODULE_MODULES = ["pdb_parser", "codeview", "lines", "varint", "neoconstruct", "constructutils", "msf"]
 
 class ProgramData:
     """
     This class holds all the data parsed from a PDB file, including type information,
     global and public symbols, and module information.
-    Since construct takes a long time to parse, this data is cached between runs.
+    Since construct takes a long time to parse, this data can be cached between runs, see ParseCache.
     """
-    def __init__(self, filename, exe, timeit=True):
+    def __init__(self, filename, exe, timeit=True, lazy_types=False, workers=1, cache=None, frozen=True):
         if timeit:
             now = None
             def timeit(desc):
@@ -238,7 +334,7 @@ class ProgramData:
         self.exename = Path(filename).stem.upper()
 
         f = open(filename, "rb")
-        msf = MsfFile.parse_stream(f)
+        msf = MsfFile.parse_stream(f, use_mmap=True)
 
         # debug information is always in stream 0x3
         dbi = DebugInfomation.parse_stream(msf.getStream(0x3))
@@ -250,64 +346,101 @@ class ProgramData:
             #print(e)
 
         module_contribs = [[] for _ in dbi.ModuleInfo]
+        section_contribs = [[] for _ in self.sections]
         for sc in dbi.SectionContribution:
             # put section contributions into the correct modules
             module_contribs[sc.ModuleIndex].append(sc)
+            section_contribs[sc.Section].append(sc)
 
-            # add to interval trees for quick lookup
             section = self.sections[sc.Section]
-
-            section.contribs[sc.Offset : sc.Offset + max(1, sc.Size)] = sc
             sc._data = section.data[sc.Offset : sc.Offset + sc.Size]
 
+        # index for quick lookup
+        for section, contribs in zip(self.sections, section_contribs):
+            section.contribs.build(contribs)
+
+        if lazy_types:
+            # Lazy types hold on to the mapped PDB, so nothing can be pickled against them
+            cache = None
+
+        # With frozen, the parsing bookkeeping is stripped from everything, see freeze()
+        # Shared, so the types aren't walked again for every module
+        frozen_seen = set()
+
+        def cached(name, modules, build):
+            def build_frozen():
+                obj = build()
+                if frozen:
+                    freeze(obj, frozen_seen)
+                return obj
+
+            if cache is None:
+                return build_frozen()
+            return cache.get(name, modules, build_frozen)
+
         timeit("parsing types")
 
-        self.types = parse_tpi(msf)
+        # lazy types are only decoded when something references them
+        self.types = cached("tpi", TPI_MODULES, lambda: parse_tpi(msf, lazy=lazy_types))
+        if cache is not None:
+            cache.types = self.types
 
         done()
         timeit("parsing GSI/PGSI")
 
-        self.gsi = Gsi.parse_stream(msf.getStream(dbi.Header.GlobalSymbolStream))
-        self.pgsi = Pgsi.parse_stream(msf.getStream(dbi.Header.PublicSymbolStream))
+        self.gsi = cached("gsi", GSI_MODULES, lambda: Gsi.parse_stream(msf.getStream(dbi.Header.GlobalSymbolStream)))
+        self.pgsi = cached("pgsi", GSI_MODULES, lambda: Pgsi.parse_stream(msf.getStream(dbi.Header.PublicSymbolStream)))
 
         done()
         timeit(f"parsing symbols")
 
         # The symbol record stream contains all globals (and public globals)
-        self.symbols = LoadSymbols(msf.getStream(dbi.Header.SymbolRecordStream), self.types)
+        self.symbols = cached("symbols", SYMBOL_MODULES,
+            lambda: LoadSymbols(msf.getStream(dbi.Header.SymbolRecordStream), self.types, frozen))
 
         done()
         timeit(f"parsing modules")
 
-        # parse all modules
-        self.modules = []
-        for i, (modi, sources, contribs) in enumerate(zip(dbi.ModuleInfo, dbi.SourceInfo.Modules, module_contribs)):
-
-            if modi.Stream != 0xffff:
-                mod_stream = msf.getStream(modi.Stream)
-                moduleStream = Struct(
-                    "Symbols" / If(modi.SymbolsSize, (RestreamData(FixedSized(modi.SymbolsSize, GreedyBytes),
-                        Struct(
-                            "Signature" / Int32ul,
-                            "Records" / RepeatUntil(lambda x, lst, ctx: x._io.tell() == modi.SymbolsSize, CodeviewRecord),
-                            #"Records" / HexDump(GreedyBytes),
-                        )
-                    ))),
-                    "Lines" / If(modi.LinesSize, (RestreamData(FixedSized(modi.LinesSize, GreedyBytes),
-                        LinesSection
-                        #HexDump(GreedyBytes),
-                    ))))
-
-                mod_details = moduleStream.parse_stream(mod_stream, types=self.types)
-
-                symbols = toTree(list(mod_details.Symbols.Records)) if mod_details.Symbols else None
-                lines = mod_details.Lines
-            else:
-                symbols = None
-                lines = None
+        # parse all modules, skipping the ones we have cached
+        results = [None] * len(dbi.ModuleInfo)
+        missing = []
+        for i in range(len(dbi.ModuleInfo)):
+            if cache is not None:
+                try:
+                    results[i] = cache.load(f"module{i}", MODULE_MODULES)
+                    continue
+                except KeyError:
+                    pass
+            missing.append(i)
+
+        modis = [dbi.ModuleInfo[i] for i in missing]
+        streams = [bytes(msf.getStream(modi.Stream).read()) if modi.Stream != 0xffff else None for modi in modis]
+
+        if workers > 1 and len(missing) > 1:
+            # Module streams are independent of each other, so they can be parsed in other processes.
+            # Types can't be shared with the workers, see TypeStub
+            jobs = [(data, modi.SymbolsSize, modi.LinesSize) for modi, data in zip(modis, streams)]
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                parsed = [load_module_result(result, self.types)
+                    for result in pool.map(parse_module_worker, jobs, chunksize=8)]
+        else:
+            parsed = [parse_module_stream(data, modi.SymbolsSize, modi.LinesSize, self.types)
+                for modi, data in zip(modis, streams)]
 
+        for i, result in zip(missing, parsed):
+            if frozen:
+                freeze(result, frozen_seen)
+            results[i] = result
+            if cache is not None:
+                cache.store(f"module{i}", MODULE_MODULES, result)
+
+        self.modules = []
+        for modi, sources, contribs, (symbols, lines) in zip(dbi.ModuleInfo, dbi.SourceInfo.Modules, module_contribs, results):
             self.modules.append((modi, sources, contribs, symbols, lines))
 
+        if frozen:
+            freeze((self.sections, self.modules), frozen_seen)
+
         done()
 
         f.close()
@@ -440,17 +573,7 @@ if __name__ == "__main__":
         print("No debug symbols")
     else:
         mod_stream = msf.getStream(modi.Stream)
-        moduleStream = Struct(
-            "Symbols" / If(modi.SymbolsSize, (RestreamData(FixedSized(modi.SymbolsSize, GreedyBytes),
-                Struct(
-                    "Signature" / Int32ul,
-                    "Records" / RepeatUntil(lambda x, lst, ctx: x._io.tell() == modi.SymbolsSize, CodeviewRecord)
-                )
-            ))),
-            "Lines" / If(modi.LinesSize, (RestreamData(FixedSized(modi.LinesSize, GreedyBytes),
-                LinesSection
-            ))),
-        )
-        symbols = moduleStream.parse_stream(mod_stream)
-        print(symbols)
+        symbols, lines = parse_module_stream(mod_stream.read(), modi.SymbolsSize, modi.LinesSize, TypeStubs())
+        printTree(symbols or [])
+        print(lines)
 
@@ -0,0 +1,29 @@
+
+# The hash function used by the PDB's hash tables (the TPI hash stream and GSI/PGSI buckets).
+# See LHashPbCb in https://github.com/microsoft/microsoft-pdb/blob/master/PDB/include/misc.h
+
+import struct
+
+def lhash(name):
+    """
+    32bit hash of a name, callers take it modulo their number of buckets.
+    The final or'ing makes it case insensitive (mostly)
+    """
+    if isinstance(name, str):
+        name = name.encode("ascii", "replace")
+
+    count = len(name) // 4
+    h = 0
+    for x in struct.unpack_from(f"<{count}I", name):
+        h ^= x
+
+    rest = name[count * 4:]
+    if len(rest) >= 2:
+        h ^= rest[0] | rest[1] << 8
+        rest = rest[2:]
+    if rest:
+        h ^= rest[0]
+
+    h |= 0x20202020
+    h ^= h >> 11
+    return h ^ (h >> 16)
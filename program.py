@@ -2,11 +2,15 @@ from pdb_parser import *
 from gsi import *
 import tpi
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import io, multiprocessing, pickle
 
 from function import Function
 from classes import parse_classes
-from item import Item, Data, StringLiterial, ThunkItem, VFTable
+from item import ItemIndex, Item, Data, StringLiterial, ThunkItem, VFTable
 from usage import Usage, TypeUsage
+from x86 import CodeSweep
+from parsecache import ShardPickler, ShardUnpickler
 
 def ext(filename : str):
     try:
@@ -98,8 +102,7 @@ class Module:
             else:
                 breakpoint()
 
-            if item.length:
-                program.items[item.address: item.address + item.length] = item
+            program.items.add(item)
             self.all_items += [item]
 
         for item in self.all_items:
@@ -113,12 +116,10 @@ class Module:
 
             if isinstance(sym, (LocalProcedureStart, GlobalProcedureStart)):
                 start, end = sym.Offset, sym.Offset + sym.Len
-                try:
-                    contrib = program.sections[sym.Segment].contribs[start:end].pop().data
+                contrib = program.sections[sym.Segment].contribs.find(start, end)
+                if contrib is not None:
                     contrib = (contrib, start - contrib.Offset)
-                except KeyError:
-                    # TODO: We should probally create a new contrib when this happens
-                    contrib = None
+                # TODO: We should probally create a new contrib when this happens
 
                 try:
                     source_file, lines = lines_map[sym.Offset].pop().data
@@ -133,8 +134,7 @@ class Module:
                 self.functions[fn.name] = fn
                 self.all_items += [fn]
 
-                if fn.length:
-                    program.items[fn.address: fn.address + fn.length] = fn
+                program.items.add(fn)
 
                 if source_file != self.sourceFile:
                     fn.source_file = source_file
@@ -260,7 +260,7 @@ class Program:
         self.types = data.types
 
         # The symbol record stream contains all globals (and public globals)
-        self.globals = Symbols(data.symbols, self.types)
+        self.globals = Symbols(data.symbols, self.types, data.pgsi)
 
         self.classes = parse_classes(self)
 
@@ -270,23 +270,29 @@ class Program:
         data.gsi.apply_visablity(Visablity.Global, self.globals)
         data.pgsi.gsi.apply_visablity(Visablity.Public, self.globals)
 
-        self.items = IntervalTree()
+        self.items = ItemIndex()
 
         module_globals = [[] for _ in data.modules]
-        for sym in self.globals:
-            try:
-                getModuleId = sym.getModuleId
-            except AttributeError:
+        for i, kind in enumerate(self.globals.kinds):
+            if not hasattr(CVSwitch.get(kind), "getModuleId"):
                 # TODO: These are enum constants (CONSTANT) AND typedefs (UserDefinedType)
                 #       We need to deal with them
                 continue
-
-            idx = getModuleId(self)
+            sym = self.globals[i]
+            idx = sym.getModuleId(self)
             if idx is not None:
                 module_globals[idx].append(sym)
             elif sym.Segment != len(self.sections) - 1:
                 self.extra_globals.append(sym)
 
+        # decode all the code up front, in address order
+        proc_ranges = defaultdict(list)
+        for (_, _, _, symbols, _) in data.modules:
+            for sym in symbols or []:
+                if isinstance(sym, (LocalProcedureStart, GlobalProcedureStart)):
+                    proc_ranges[sym.Segment].append((sym.Offset, sym.Offset + sym.Len))
+        self.sweeps = {seg: CodeSweep(self.sections[seg], ranges) for seg, ranges in proc_ranges.items()}
+
         # process all modules
         for i, (modi, sources, contribs, symbols, lines) in enumerate(data.modules):
 
@@ -307,7 +313,7 @@ class Program:
             self.moduleByName[name.lower()] = m
             library.addModule(m)
 
-    def post_process(self, module=None):
+    def post_process(self, module=None, workers=1, threads=False):
         for g in self.extra_globals:
             if isinstance(g, GlobalData):
                 # Todo: These are globals that are not in any module... for some reason
@@ -327,8 +333,7 @@ class Program:
 
 
                 item = Data(g, addr, g.Type)
-                if item.length:
-                    self.items[item.address: item.address + item.length] = item
+                self.items.add(item)
             if isinstance(g, LocalData):
                 print(f"LocalData {g.Name} in extra_globals, this should not happen")
 
@@ -345,12 +350,32 @@ class Program:
         if module is not None:
             for item in self.modules[module].all_items:
                 item.post_process()
+            return
+
+        modules = [m for m in self.modules if not (m.library.is_dll() or m.library.is_mslib())]
+        if workers > 1 and threads:
+            # Lifting keeps no global state, so on a free-threaded build the modules can be done on threads
+            # without copying anything between processes
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(post_process_module, modules))
+        elif workers > 1:
+            # Functions are analysed independently, so each module can be done by a forked worker
+            # that inherits this Program. Only the results of parse_body are sent back.
+            global worker_program
+            worker_program = self
+            shared = program_objects(self)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("fork")) as pool:
+                for m, results in zip(modules, pool.map(post_process_worker, [m.idx for m in modules])):
+                    # In all_items order, like the serial loop
+                    for i, item in enumerate(m.all_items):
+                        if i in results:
+                            load_post_process_result(item, results[i], shared)
+                        else:
+                            item.post_process()
+            worker_program = None
         else:
-            for m in self.modules:
-                if m.library.is_dll() or m.library.is_mslib():
-                    continue
-                for item in m.all_items:
-                    item.post_process()
+            for m in modules:
+                post_process_module(m)
 
 
     def getInclude(self, filename):
@@ -364,62 +389,147 @@ class Program:
         return self.sections[segment].va + offset
 
     def getItem(self, addr):
-        item = self.items[addr]
-
-        if item:
-            return item.pop().data
-        return None
+        return self.items.find(addr)
 
 
 class Symbols:
-    def __init__(self, symbols, types):
-        self.symbols = []
-        self.byRecOffset = {}
-        self.bySegOffset = defaultdict(list)
-
-        for i, rec in enumerate(symbols):
-            offset = rec._addr
+    """
+    The global symbols, stripped of their record wrapper.
+    Each one is only decoded from the SymbolRecords when something asks for it.
+    """
+    def __init__(self, records, types, pgsi):
+        self.records = records
+        self.symbols = [None] * len(records)
+        self.kinds = records.kinds
+
+        # Built from the framed records, so nothing is decoded
+        self.byAddr = AddrMap(records.addresses(), self.__getitem__)
+        # The public symbols, from the PGSI address map
+        self.publics = AddrMap(pgsi.addresses(records), self.__getitem__)
+
+        for i, kind in enumerate(self.kinds):
+            if address_fields(kind) is None and CVSwitch.get(kind) not in (UserDefinedType, Constant, ProcRef, LocalProcRef):
+                # Todo: work out what these proc refs are
+                print(self[i])
+                breakpoint()
 
-            # Strip the record wrapper
-            rec = rec.Data
+    def __getitem__(self, i):
+        rec = self.symbols[i]
+        if rec is not None:
+            return rec
 
-            rec.index = i
-            rec.visablity = Visablity.Unknown
-            rec.refcount = 0
+        # Strip the record wrapper
+        rec = self.records[i].Data
 
-            self.symbols.append(rec)
-            self.byRecOffset[offset] = rec
+        rec.index = i
+        rec.visablity = Visablity.Unknown
+        rec.refcount = 0
 
-            try:
-                self.bySegOffset[(rec.Segment, rec.Offset)].append(rec)
-            except AttributeError:
-                if isinstance(rec, UserDefinedType):
-                    pass
-                elif not isinstance(rec, (Constant, ProcRef, LocalProcRef)):
-                    # Todo: work out what these proc refs are
-                    print(rec)
-                    breakpoint()
+        # Link symbol with type
+        try:
+            rec.Type._symbols.append(rec)
+        except AttributeError:
+            pass
 
-            # Link symbol with type
-            try:
-                rec.Type._symbols.append(rec)
-            except AttributeError:
-                pass
+        self.symbols[i] = rec
+        return rec
 
     def fromOffset(self, offset):
         try:
-            return self.byRecOffset[offset]
+            i = self.records.index[offset]
         except KeyError:
             return None
+        return self[i]
 
-    def fromSegmentOffset(self, segment, offset):
-        try:
-            return self.bySegOffset[(segment, offset)]
-        except KeyError:
-            return None
-
-    def __getitem__(self, index):
-        return self.symbols[index]
+    def fromSegmentOffset(self, segment, offset, nearest=False, above=False):
+        # With nearest, returns the public symbols at the closest address at or below segment:offset (or above)
+        if nearest:
+            return self.publics.nearest(segment, offset, above)
+        return self.byAddr.at(segment, offset)
 
     def __len__(self):
         return len(self.symbols)
+
+    def __iter__(self):
+        for i in range(len(self.symbols)):
+            yield self[i]
+
+
+def post_process_module(m):
+    for item in m.all_items:
+        item.post_process()
+
+# The program being post processed, inherited by the forked workers
+worker_program = None
+worker_refs = None
+
+# The function attributes parse_body sets.
+# Along with the state of the body's nodes, these are all a forked worker sends back.
+# Everything else in Function.post_process_objects() (labels, scopes, locals, args and instructions)
+# is sent as a reference to the parent's copy, so parse_body must not change them or the change is lost.
+POST_PROCESS_ATTRS = ("prolog", "epilog", "body", "return_bb", "backedges", "block")
+
+def program_objects(program):
+    # The objects parse_body results can refer to which are shared by all functions
+    return [program, *program.modules, *program.items]
+
+class PostProcessPickler(ShardPickler):
+    # Anything that already existed before parse_body ran is pickled as a reference,
+    # the parent process has an identical copy of it
+    def __init__(self, file, types, refs, objects):
+        super().__init__(file, types)
+        self.refs = refs
+        self.fn_refs = {id(obj): i for i, obj in enumerate(objects)}
+
+    def persistent_id(self, obj):
+        if (i := self.fn_refs.get(id(obj))) is not None:
+            return ("fn", i)
+        if (i := self.refs.get(id(obj))) is not None:
+            return ("program", i)
+        return super().persistent_id(obj)
+
+class PostProcessUnpickler(ShardUnpickler):
+    def __init__(self, file, types, shared, objects):
+        super().__init__(file, types)
+        self.shared = shared
+        self.objects = objects
+
+    def persistent_load(self, pid):
+        match pid:
+            case ("fn", i):
+                return self.objects[i]
+            case ("program", i):
+                return self.shared[i]
+        return super().persistent_load(pid)
+
+def post_process_worker(idx):
+    # Returns the pickled results of parse_body, for each function in the module
+    global worker_refs
+    program = worker_program
+    if worker_refs is None:
+        worker_refs = {id(obj): i for i, obj in enumerate(program_objects(program))}
+
+    results = {}
+    for i, item in enumerate(program.modules[idx].all_items):
+        if not isinstance(item, Function) or not item.has_body():
+            # Still run it, so the functions after it see the same state as a serial run
+            item.post_process()
+            continue
+        nodes, objects = item.post_process_objects()
+        item.post_process()
+
+        fn_state = {k: item.__dict__[k] for k in POST_PROCESS_ATTRS if k in item.__dict__}
+        # the lifted instructions are only a cache, leave them behind
+        node_states = [{k: v for k, v in node.__dict__.items() if k != "lifted"} for node in nodes]
+
+        f = io.BytesIO()
+        PostProcessPickler(f, program.types, worker_refs, objects).dump((fn_state, node_states))
+        results[i] = f.getvalue()
+    return results
+
+def load_post_process_result(fn, result, shared):
+    nodes, objects = fn.post_process_objects()
+    fn_state, node_states = PostProcessUnpickler(io.BytesIO(result), fn.p.types, shared, objects).load()
+    for node, state in zip(nodes, node_states):
+        node.__dict__.update(state)
+    fn.__dict__.update(fn_state)
@@ -140,10 +140,10 @@ class Scope:
                 item = p.getItem(addr)
                 if not item:
                     # find contrib, it will be in this module
-                    for ctrb in fn.module.sectionContribs:
-                        if ctrb.Section == c.Segment and c.Offset >= ctrb.Offset and c.Offset < ctrb.Offset + ctrb.Size:
-                            contrib = (ctrb, c.Offset - ctrb.Offset)
-                            break
+                    contrib = None
+                    ctrb = p.sections[c.Segment].contribs.find(c.Offset, module=fn.module, sized=True)
+                    if ctrb is not None:
+                        contrib = (ctrb, c.Offset - ctrb.Offset)
                     item = Data(c, p.getAddr(c.Segment, c.Offset), c.Type, contrib=contrib)
 
                 local = LocalData(c.Name, c.Type, size, self, fn, item)
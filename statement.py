@@ -22,7 +22,7 @@ class BasicBlock:
         self.before = None
         self.after = None
         self.branch_id = None
-
+        self.lifted = None
 
         self.statements = []
 
@@ -39,19 +39,24 @@ class BasicBlock:
 
 
     def as_asm(self):
-        return ir.as_asm(self.data(), self.address(), self.scope)
+        return ir.as_asm(self.instructions(), self.scope)
+
 
+    def instructions(self):
+        return self.scope.fn.instructions(self.start, self.end)
 
     def insts(self):
-        state = ir.State()
-        ir.set_scope(self.scope)
-        return [I.from_inst(i, state) for i in x86.disassemble(self.data(), self.address())]
+        return self.decomp()[1]
 
     def decomp(self):
-        state = ir.State()
-        ir.set_scope(self.scope)
-        insts = [I.from_inst(i, state) for i in x86.disassemble(self.data(), self.address())]
-        return state, insts
+        # Lifted once and shared by all the matchers, until the prolog/epilog matching moves start or end
+        if self.lifted is None or self.lifted[0] != (self.start, self.end):
+            state = ir.State()
+            ctx = ir.LiftContext(self.scope)
+            insts = [I.from_inst(i, state, ctx) for i in self.instructions()]
+            self.lifted = (self.start, self.end), state, insts
+        _, state, insts = self.lifted
+        return state, list(insts)
 
     def data(self):
         return self.scope.fn.data()[self.start:self.end]
@@ -6,7 +6,35 @@ from base_types import cast_access, ScaleExpr
 from constructutils import *
 
 from varint import VarInt
+from msf import le_array
 from collections import defaultdict
+from array import array
+import functools, inspect
+
+# Rendering a declaration walks the whole pointer/modifier/array chain of its type, and full
+# dumps render the same few thousand type strings millions of times.
+# So typestr()/shortstr() results are cached on each type, keyed by name, as types don't change once linked.
+# The cache lives in the instance __dict__ rather than as a Container item, so it isn't one of the record's fields
+# (and isn't printed, compared or pickled with them).
+def memoize_str(fn):
+    key = fn.__name__
+    takes_name = len(inspect.signature(fn).parameters) > 1
+
+    @functools.wraps(fn)
+    def wrapper(self, name=None):
+        try:
+            cache = self.__dict__["_strs"]
+        except KeyError:
+            cache = self.__dict__["_strs"] = {}
+
+        try:
+            return cache[key, name]
+        except KeyError:
+            pass
+        s = fn(self, name) if takes_name else fn(self)
+        cache[key, name] = s
+        return s
+    return wrapper
 
 class TypeLeaf(ConstructClass):
     con = None  # Construct class for this type, if applicable
@@ -15,37 +43,15 @@ class TypeLeaf(ConstructClass):
         self._symbols = set()
         self._usage = set()
 
-    def linkTIs(self, other, tpi, history=set()):
-        if id(self) in history:
-            return
-        history.add(id(self))
-        for k, lf in self.items():
-            if k.startswith("_"):
-                continue
-            if isinstance(lf, TypeIndex):
-                self[k] = lf.link(self, tpi)
-            elif isinstance(lf, ListContainer) or isinstance(lf, list):
-                for item in lf:
-                    if isinstance(item, TypeLeaf):
-                        item.TI = self.TI
-                        item.linkTIs(other, tpi, history)
-
-    def addRef(self, ref):
-        if not ref:
-            return
-        if isinstance(ref, TypeIndex):
-            TI = ref.value
-        else:
-            TI = ref.TI
-        try:
-            self._refs.add(TI)
-        except AttributeError:
-            self._refs = set()
-            self._refs.add(TI)
+    def linked(self, tpi):
+        # Called by Types.linkType, once all the TypeIndexes have been resolved
+        pass
 
+    @memoize_str
     def shortstr(self):
         return self.__str__()
 
+    @memoize_str
     def typestr(self, name=None):
         if name:
             return f"{self.shortstr()} {name}"
@@ -86,8 +92,7 @@ class TypeIndex(ConstructValueClass):
             breakpoint()
 
     def link(self, other, tpi):
-        #self.Type = tpi.types[self.value]
-        self.Type.addRef(other)
+        tpi.refs.add(self.value, other.TI)
         return self.Type
 
     def __str__(self):
@@ -284,6 +289,7 @@ class LfModifier(TypeLeaf):
     def __str__(self):
         return f"{self.mods()}{self.Type.shortstr()}"
 
+    @memoize_str
     def typestr(self, name=None):
         return f"{self.mods()}{self.Type.typestr(name)}"
 
@@ -352,10 +358,12 @@ class LfPointer(TypeLeaf):
             s += " "
         return s
 
+    @memoize_str
     def shortstr(self):
         s = f"{self.Attributes.ptrmode} to: {self.Type.shortstr()}"
         return self.attributes() + s
 
+    @memoize_str
     def typestr(self, name=None):
         match self.Attributes.ptrmode:
             case "Ptr":
@@ -429,9 +437,11 @@ class LfArray(TypeLeaf):
         emnts = [init(x) for x in parsed]
         return f"{{{', '.join(emnts)}}}"
 
+    @memoize_str
     def shortstr(self):
         return self.typestr()
 
+    @memoize_str
     def typestr(self, name=None):
         element_size = self.Type.type_size()
         try:
@@ -472,8 +482,7 @@ class LfArray(TypeLeaf):
 
 
 class FrowardRef(TypeLeaf):
-    def linkTIs(self, other, tpi):
-        TypeLeaf.linkTIs(self, other, tpi)
+    def linked(self, tpi):
         if self.properties.fwdref:
             # The PDB has many duplicate definitions for types.
             # There are two sources of duplicates:
@@ -486,7 +495,7 @@ class FrowardRef(TypeLeaf):
             for ty in reversed(tpi.byName[self.Name]):
                 if ty.__class__ == self.__class__ and ty.properties == props:
                     self._definition = ty
-                    ty.addRef(self)
+                    tpi.refs.add(ty.TI, self.TI)
                     return
             if getattr(self, "Size", None) == 0:
                 # Almost certainly an empty struct
@@ -504,6 +513,7 @@ class FrowardRef(TypeLeaf):
             pass
         return TypeLeaf.__str__(self)
 
+    @memoize_str
     def shortstr(self):
         packed = "/*packed*/ " if self.properties.packed else "/*unpacked*/ "
         if isinstance(self, LfEnum):
@@ -537,7 +547,7 @@ class LfClass(FrowardRef):
             try:
                 return self._definition.type_size()
             except AttributeError:
-                raise Exception(f"Forward reference {self.Name} has no definition")
+                raise ValueError(f"Forward reference {self.Name} has no definition")
             if self._definition:
                 self._definition.type_size()
             else:
@@ -649,8 +659,7 @@ class LfProcedure(TypeLeaf):
         "arglist" / TypeIndex, # type index of argument list
     )
 
-    def linkTIs(self, other, tpi):
-        super().linkTIs(other, tpi)
+    def linked(self, tpi):
         if self.parmcount:
             self.args = [arg.link(self, tpi) for arg in self.arglist.args]
             assert self.parmcount == len(self.args)
@@ -659,6 +668,7 @@ class LfProcedure(TypeLeaf):
         del self.arglist
         del self.parmcount
 
+    @memoize_str
     def shortstr(self):
         s = f"{self.rvtype} ("
         for arg in self.args:
@@ -666,6 +676,7 @@ class LfProcedure(TypeLeaf):
         s += ")"
         return s
 
+    @memoize_str
     def typestr(self, name=None):
         args = ", ".join(arg.typestr() for arg in self.args)
         if name:
@@ -690,8 +701,7 @@ class LfMemberFunction(TypeLeaf):
         "thisadjust" / Int32sl, # this adjuster (long because pad required anyway)
     )
 
-    def linkTIs(self, other, tpi):
-        super().linkTIs(other, tpi)
+    def linked(self, tpi):
         if self.parmcount:
             self.args = [arg.link(self, tpi) for arg in self.arglist.args]
             assert self.parmcount == len(self.args)
@@ -729,6 +739,7 @@ class LfVtShape(TypeLeaf):
         )),
     )
 
+    @memoize_str
     def shortstr(self):
         return f"VtShape({self.count}) [{', '.join(str(x) for x in self.desc)}]"
 
@@ -904,13 +915,14 @@ class TypeRecord(ConstructClass):
 # This some kind of skip list that allows implementations to quickly find the TI they are looking for
 # It links to the first whole record after each 8KB boundary
 class Skip(ConstructClass):
+    compiled_parse = True
     subcon = Struct(
         "TI" / Int16ul,
         "unk" / Int16ul, # Usually in the ranges 0x80-8f or 0xe0-0xef... Might be which mfs page?
         "off" / Int32ul
     )
 
-class TypeInfomation(ConstructClass):
+class TypeInfomationHeader(ConstructClass):
     """
         See struct HDR_16t from: https://github.com/microsoft/microsoft-pdb/blob/master/PDB/dbi/tpi.h
     """
@@ -924,31 +936,8 @@ class TypeInfomation(ConstructClass):
         # see parseHashes, doesn't seem to have useful infomation
         "HashValueStream" / Int16ul,
         "Padding" / Const(0, Int16ul), # padding, always 0
-        "Records" / Array(this.MaximumTI - this.MinimumTI, TypeRecord)
     )
 
-    def parsed(self, ctx):
-        idx = self.MinimumTI
-        byName = defaultdict(list)
-
-        for rec in self.Records:
-            addr = rec._addr
-            rec = rec.Data
-            assert rec._idx == idx
-            idx += 1
-            ctx.types.byRecOffset[addr] = rec
-
-            if hasattr(rec, "Name"):
-                byName[rec.Name].append(rec)
-
-        ctx.types.byName = dict(byName)
-
-        for ty in ctx.types.types:
-            if isinstance(ty, TypeLeaf):
-                ty.linkTIs(None, ctx.types)
-
-        ctx.types.finalize()
-
     def parseHashes(self, msf):
         if self.HashValueStream == 0:
             return
@@ -959,7 +948,7 @@ class TypeInfomation(ConstructClass):
 
         # There is one bucket idx (in the range 0 to 4095) per TI
         # presumably the same hash function as used in GSI
-        self.buckets = list(Array(numTypes, Int16ul).parse_stream(stream))
+        self.buckets = le_array('H', stream.read(numTypes * 2))
 
         skiplist = list(GreedyRange(Skip).parse_stream(stream))
         self.skiplist = skiplist
@@ -969,14 +958,122 @@ class TypeInfomation(ConstructClass):
         #     print(self.types[o.TI])
 
 
+class TypeInfomation(TypeInfomationHeader):
+    subcon = Struct(
+        *TypeInfomationHeader.subcon.subcons,
+        "Records" / Array(this.MaximumTI - this.MinimumTI, TypeRecord)
+    )
+
+    def parsed(self, ctx):
+        ctx.types.link([(rec._addr, rec.Data) for rec in self.Records], self.MinimumTI)
+
+
+class TypeRefs:
+    """
+    Back-references between types, for each TI the TIs of types that refer to it.
+    Stored as two flat arrays (row starts indexed by TI, and the refs themselves)
+    rather than a set on every type. New refs are kept in a pending list until the
+    next build()
+    """
+
+    def __init__(self):
+        self.starts = array('I', [0])
+        self.refs = array('I')
+        self.pending = array('Q')
+
+    def add(self, TI, ref):
+        self.pending.append(TI << 32 | ref)
+
+    def build(self):
+        starts, refs = self.starts, self.refs
+        edges = set(self.pending)
+        for TI in range(len(starts) - 1):
+            for ref in refs[starts[TI]:starts[TI + 1]]:
+                edges.add(TI << 32 | ref)
+        edges = sorted(edges)
+
+        count = (edges[-1] >> 32) + 1 if edges else 0
+        starts = array('I', bytes(4 * (count + 1)))
+        for edge in edges:
+            starts[(edge >> 32) + 1] += 1
+        for TI in range(count):
+            starts[TI + 1] += starts[TI]
+
+        self.starts = starts
+        self.refs = array('I', (edge & 0xffffffff for edge in edges))
+        self.pending = array('Q')
+
+    def __getitem__(self, TI):
+        if len(self.pending) > max(1024, len(self.refs) // 4):
+            self.build()
+
+        starts = self.starts
+        refs = self.refs[starts[TI]:starts[TI + 1]].tolist() if TI + 1 < len(starts) else []
+        if self.pending:
+            extra = [edge & 0xffffffff for edge in self.pending if edge >> 32 == TI]
+            if extra:
+                refs = sorted(set(refs + extra))
+        return tuple(refs)
+
+
 class Types:
     def __init__(self):
         import base_types
         self.types = list(base_types.types)
 
         self.byRecOffset = {}
-        self.byStr = {}
+        self.byStr = None
+        self.refs = TypeRefs()
+
+
+    def link(self, records, first_ti):
+        """
+        records: (stream offset, leaf) for every type record, in TI order
+        """
+        idx = first_ti
+        byName = defaultdict(list)
+
+        for addr, rec in records:
+            assert rec._idx == idx
+            idx += 1
+            self.byRecOffset[addr] = rec
+
+            if hasattr(rec, "Name"):
+                byName[rec.Name].append(rec)
+
+        self.byName = dict(byName)
+
+        for ty in self.types:
+            if isinstance(ty, TypeLeaf):
+                self.linkType(ty)
+        self.refs.build()
 
+    def linkType(self, ty):
+        """
+        Replaces the TypeIndexes in a type (and the members of its field/method lists)
+        with the types they refer to, recording the back-references in refs.
+        """
+        TI = ty.TI
+        work = [ty]
+        while work:
+            leaf = work.pop()
+            for k, lf in leaf.items():
+                if k.startswith("_"):
+                    continue
+                if isinstance(lf, TypeIndex):
+                    leaf[k] = lf.link(ty, self)
+                elif isinstance(lf, list):
+                    for item in lf:
+                        if isinstance(item, TypeLeaf):
+                            item.TI = TI
+                            work.append(item)
+        ty.linked(self)
+
+    def refsTo(self, TI):
+        """
+        TIs of the types that refer to a type
+        """
+        return self.refs[TI]
 
     def fromOffset(self, offset):
         try:
@@ -998,16 +1095,31 @@ class Types:
         """
         Find a type by its string representation.
         """
+        if self.byStr is None:
+            # Stringifying every type is slow, only do it once something needs it
+            self.finalize()
         if types := self.byStr.get(name):
             if len(types) == 1:
                 return types[0]
             breakpoint()
 
-def parse_tpi(msf):
-    tpi = Types()
-
+def parse_tpi(msf, fast=True, lazy=False):
     # The type records are always in stream 2
-    info = TypeInfomation.parse_stream(msf.getStream(2), types=tpi)
+    stream = msf.getStream(2)
+    if lazy:
+        # Types are decoded on first access
+        import tpi_fast
+        info = TypeInfomationHeader.parse_stream(stream)
+        return tpi_fast.LazyTypes(msf, stream, info)
+
+    tpi = Types()
+    if fast:
+        import tpi_fast
+        info = TypeInfomationHeader.parse_stream(stream)
+        tpi.link(tpi_fast.parse_records(stream, info, tpi), info.MinimumTI)
+    else:
+        # Slower, but useful for verifying tpi_fast
+        info = TypeInfomation.parse_stream(stream, types=tpi)
     #info.parseHashes(msf)
 
     #tpi.skiplist = info.skiplist
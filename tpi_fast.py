@@ -0,0 +1,806 @@
+
+# Hand-written decoder for the TPI type records.
+#
+# Going through construct's Switch for every record (and the generic offset recalculation
+# in ConstructClass._parse) makes type parsing the slowest phase of loading a pdb.
+# This produces the same TypeLeaf objects as the construct definitions in tpi.py, using
+# precompiled struct unpackers on a single view of the stream.
+#
+# Anything it doesn't understand (unknown leaves, truncated records, bad strings) is handed
+# back to construct, one record at a time, so the results (and errors) match exactly.
+# Use parse_tpi(msf, fast=False) to get the pure construct path for comparison.
+
+import struct, gc, bisect, re
+from array import array
+from collections import defaultdict
+from construct import Container, ListContainer
+
+from constructutils import DecDisplayedInteger
+from varint import VarInt, VARINT_TYPES
+from pdbhash import lhash
+from tpi import *
+
+u16 = struct.Struct("<H")
+u16x2 = struct.Struct("<HH")
+s32 = struct.Struct("<i")
+u32 = struct.Struct("<I")
+
+class Unsupported(Exception):
+    pass
+
+# Bitfields and enums are decoded once per raw value by construct, then shared.
+# Nothing modifies them after parsing (FrowardRef.linked works on a copy)
+g_bitfields = {}
+
+def bitfield(cls, raw):
+    try:
+        return g_bitfields[cls, raw]
+    except KeyError:
+        value = g_bitfields[cls, raw] = cls.parse(raw)
+        return value
+
+def calltype(raw):
+    try:
+        return g_bitfields[CallingConvention, raw]
+    except KeyError:
+        value = g_bitfields[CallingConvention, raw] = CallingConvention.parse(bytes([raw]))
+        return value
+
+
+class Decoder:
+    def __init__(self, stream, buf, types):
+        self.stream = stream
+        self.buf = buf
+        self.types = types
+        self.end = 0
+
+        self.leaves = {
+            LfModifier.type: self.LfModifier,
+            LfPointer.type: self.LfPointer,
+            LfArray.type: self.LfArray,
+            LfClass.type: lambda off: self.LfClass(off, LfClass),
+            LfStruct.type: lambda off: self.LfClass(off, LfStruct),
+            LfUnion.type: self.LfUnion,
+            LfEnum.type: self.LfEnum,
+            LfProcedure.type: self.LfProcedure,
+            LfMemberFunction.type: self.LfMemberFunction,
+            LfVftPath.type: self.LfVftPath,
+            LfArgList.type: self.LfArgList,
+            LfFieldList.type: self.LfFieldList,
+            LfBitfield.type: self.LfBitfield,
+            LfMethodList.type: self.LfMethodList,
+            LfBaseClass.type: self.LfBaseClass,
+            LfVirtualBaseClass.type: lambda off: self.LfVirtualBaseClass(off, LfVirtualBaseClass),
+            LfIndirectVirtualBaseClass.type: lambda off: self.LfVirtualBaseClass(off, LfIndirectVirtualBaseClass),
+            LfEnumerate.type: self.LfEnumerate,
+            LfMember.type: self.LfMember,
+            LfStaticMember.type: self.LfStaticMember,
+            LfMethod.type: self.LfMethod,
+            LfNestedType.type: self.LfNestedType,
+            LfVFuncTab.type: self.LfVFuncTab,
+            LfOneMethod.type: self.LfOneMethod,
+        }
+
+    def need(self, off, size):
+        if off + size > self.end:
+            raise Unsupported()
+
+    def new(self, cls, addr, end, fields):
+        # Mirrors what ConstructClass._parse and TypeLeaf.parsed leave behind.
+        # Container.__setattr__ is slow, so the keys are filled in with a single update
+        obj = cls.__new__(cls)
+        stream = self.stream
+        items = [("_addr", addr), ("_meta", {}), ("_size", end - addr), ("_io", stream)]
+        items += fields
+        items += (("_pointers", set()), ("_stream", stream))
+        if cls.parsed is TypeLeaf.parsed:
+            items += (("_symbols", set()), ("_usage", set()))
+        dict.update(obj, items)
+        return obj
+
+    def typeindex(self, off):
+        value, = u16.unpack_from(self.buf, off)
+        ti = TypeIndex.__new__(TypeIndex)
+        ty = self.types[value]
+        ti.__dict__.update(_addr=off, _meta={}, _size=2, value=value,
+                           _pointers=set(), _stream=self.stream, Type=ty)
+        if ty is None and value != 0:
+            breakpoint()
+        return ti
+
+    def varint(self, off):
+        self.need(off, 2)
+        typeOrVal, = u16.unpack_from(self.buf, off)
+        end = off + 2
+        value = typeOrVal
+        if unpacker := VARINT_TYPES.get(typeOrVal):
+            self.need(end, unpacker.size)
+            value, = unpacker.unpack_from(self.buf, end)
+            end += unpacker.size
+
+        v = VarInt.__new__(VarInt)
+        dict.update(v, (("_addr", off), ("_meta", {}), ("_size", end - off), ("_io", self.stream),
+                               ("typeOrVal", typeOrVal), ("value", value),
+                               ("_pointers", set()), ("_stream", self.stream)))
+        return v, end
+
+    def attr(self, cls, off, size=2):
+        self.need(off, size)
+        return bitfield(cls, bytes(self.buf[off:off+size]))
+
+    def name(self, off):
+        self.need(off, 1)
+        length = self.buf[off]
+        self.need(off + 1, length)
+        return bytes(self.buf[off+1:off+1+length]).decode("ascii"), off + 1 + length
+
+    def typeindexes(self, off, count):
+        self.need(off, count * 2)
+        return ListContainer(self.typeindex(off + i * 2) for i in range(count))
+
+    def LfModifier(self, off):
+        self.need(off, 4)
+        return self.new(LfModifier, off, off + 4, (
+            ("Attributes", self.attr(ModifierAttributes, off)),
+            ("Type", self.typeindex(off + 2)),
+        ))
+
+    def LfPointer(self, off):
+        self.need(off, 4)
+        return self.new(LfPointer, off, off + 4, (
+            ("Attributes", self.attr(PointerAttributes, off)),
+            ("Type", self.typeindex(off + 2)),
+        ))
+
+    def LfArray(self, off):
+        self.need(off, 4)
+        ty = self.typeindex(off)
+        index = self.typeindex(off + 2)
+        size, end = self.varint(off + 4)
+        self.need(end, 1)
+        if self.buf[end] != 0:
+            raise Unsupported()
+        return self.new(LfArray, off, end + 1, (
+            ("Type", ty),
+            ("IndexType", index),
+            ("Size", size),
+        ))
+
+    def LfClass(self, off, cls):
+        self.need(off, 10)
+        count, = u16.unpack_from(self.buf, off)
+        fields = [
+            ("count", DecDisplayedInteger.new(count)),
+            ("fieldList", self.typeindex(off + 2)),
+            ("properties", self.attr(StructProperty, off + 4)),
+            ("derivedList", self.typeindex(off + 6)),
+            ("vshape", self.typeindex(off + 8)),
+        ]
+        size, end = self.varint(off + 10)
+        name, end = self.name(end)
+        fields += [("Size", size), ("Name", name)]
+        return self.new(cls, off, end, fields)
+
+    def LfUnion(self, off):
+        self.need(off, 6)
+        count, = u16.unpack_from(self.buf, off)
+        fields = [
+            ("count", DecDisplayedInteger.new(count)),
+            ("fieldList", self.typeindex(off + 2)),
+            ("properties", self.attr(StructProperty, off + 4)),
+        ]
+        size, end = self.varint(off + 6)
+        name, end = self.name(end)
+        fields += [("Size", size), ("Name", name)]
+        return self.new(LfUnion, off, end, fields)
+
+    def LfEnum(self, off):
+        self.need(off, 8)
+        count, = u16.unpack_from(self.buf, off)
+        fields = [
+            ("count", DecDisplayedInteger.new(count)),
+            ("utype", self.typeindex(off + 2)),
+            ("fieldList", self.typeindex(off + 4)),
+            ("properties", self.attr(StructProperty, off + 6)),
+        ]
+        name, end = self.name(off + 8)
+        fields.append(("Name", name))
+        return self.new(LfEnum, off, end, fields)
+
+    def LfProcedure(self, off):
+        self.need(off, 8)
+        return self.new(LfProcedure, off, off + 8, (
+            ("rvtype", self.typeindex(off)),
+            ("calltype", calltype(self.buf[off + 2])),
+            ("funcattr", self.attr(FunctionAttributies, off + 3, 1)),
+            ("parmcount", u16.unpack_from(self.buf, off + 4)[0]),
+            ("arglist", self.typeindex(off + 6)),
+        ))
+
+    def LfMemberFunction(self, off):
+        self.need(off, 16)
+        return self.new(LfMemberFunction, off, off + 16, (
+            ("rvtype", self.typeindex(off)),
+            ("classtype", self.typeindex(off + 2)),
+            ("thistype", self.typeindex(off + 4)),
+            ("calltype", calltype(self.buf[off + 6])),
+            ("funcattr", self.attr(FunctionAttributies, off + 7, 1)),
+            ("parmcount", u16.unpack_from(self.buf, off + 8)[0]),
+            ("arglist", self.typeindex(off + 10)),
+            ("thisadjust", s32.unpack_from(self.buf, off + 12)[0]),
+        ))
+
+    def LfVftPath(self, off):
+        self.need(off, 2)
+        count, = u16.unpack_from(self.buf, off)
+        bases = self.typeindexes(off + 2, count)
+        return self.new(LfVftPath, off, off + 2 + count * 2, (
+            ("count", count),
+            ("bases", bases),
+        ))
+
+    def LfArgList(self, off):
+        self.need(off, 2)
+        count, = u16.unpack_from(self.buf, off)
+        args = self.typeindexes(off + 2, count)
+        return self.new(LfArgList, off, off + 2 + count * 2, (
+            ("count", count),
+            ("args", args),
+        ))
+
+    def LfFieldList(self, off):
+        # Each entry is a 16bit leaf type followed by the leaf, aligned to 4 bytes.
+        # Construct's GreedyRange quietly stops at the first entry that fails to parse,
+        # only the clean end of the record is handled here.
+        data = ListContainer()
+        pos = off
+        while pos != self.end:
+            self.need(pos, 2)
+            leaf_type, = u16.unpack_from(self.buf, pos)
+            try:
+                decode = self.leaves[leaf_type]
+            except KeyError:
+                raise Unsupported()
+            leaf = decode(pos + 2)
+            end = pos + 2 + leaf._size
+            end += -(end - pos) % 4
+            self.need(end, 0)
+            data.append(leaf)
+            pos = end
+        return self.new(LfFieldList, off, pos, (("Data", data),))
+
+    def LfBitfield(self, off):
+        self.need(off, 4)
+        length, position = self.buf[off], self.buf[off + 1]
+        return self.new(LfBitfield, off, off + 4, (
+            ("length", length),
+            ("position", position),
+            ("type", self.typeindex(off + 2)),
+        ))
+
+    def LfMethodList(self, off):
+        data = ListContainer()
+        pos = off
+        while pos != self.end:
+            self.need(pos, 4)
+            attr = self.attr(FieldAttributes, pos)
+            index = self.typeindex(pos + 2)
+            end = pos + 4
+            vbaseoffset = None
+            if attr.mprop in ("intro", "pureintro"):
+                self.need(end, 4)
+                vbaseoffset, = u32.unpack_from(self.buf, end)
+                end += 4
+            data.append(self.new(MethodListEntry, pos, end, (
+                ("attr", attr),
+                ("index", index),
+                ("vbaseoffset", vbaseoffset),
+            )))
+            pos = end
+        return self.new(LfMethodList, off, pos, (("Data", data),))
+
+    def LfBaseClass(self, off):
+        self.need(off, 4)
+        index = self.typeindex(off)
+        attr = self.attr(FieldAttributes, off + 2)
+        offset, end = self.varint(off + 4)
+        return self.new(LfBaseClass, off, end, (
+            ("index", index),
+            ("attr", attr),
+            ("offset", offset),
+        ))
+
+    def LfVirtualBaseClass(self, off, cls):
+        self.need(off, 6)
+        index = self.typeindex(off)
+        vbptr = self.typeindex(off + 2)
+        attr = self.attr(FieldAttributes, off + 4)
+        ptroffset, end = self.varint(off + 6)
+        vtableoffset, end = self.varint(end)
+        return self.new(cls, off, end, (
+            ("index", index),
+            ("vbptr", vbptr),
+            ("attr", attr),
+            ("ptroffset", ptroffset),
+            ("vtableoffset", vtableoffset),
+        ))
+
+    def LfEnumerate(self, off):
+        attr = self.attr(FieldAttributes, off)
+        value, end = self.varint(off + 2)
+        name, end = self.name(end)
+        return self.new(LfEnumerate, off, end, (
+            ("attr", attr),
+            ("value", value),
+            ("Name", name),
+        ))
+
+    def LfMember(self, off):
+        self.need(off, 4)
+        index = self.typeindex(off)
+        attr = self.attr(FieldAttributes, off + 2)
+        offset, end = self.varint(off + 4)
+        name, end = self.name(end)
+        return self.new(LfMember, off, end, (
+            ("index", index),
+            ("attr", attr),
+            ("offset", offset),
+            ("Name", name),
+        ))
+
+    def LfStaticMember(self, off):
+        self.need(off, 4)
+        index = self.typeindex(off)
+        attr = self.attr(FieldAttributes, off + 2)
+        name, end = self.name(off + 4)
+        return self.new(LfStaticMember, off, end, (
+            ("index", index),
+            ("attr", attr),
+            ("Name", name),
+        ))
+
+    def LfMethod(self, off):
+        self.need(off, 4)
+        count, = u16.unpack_from(self.buf, off)
+        methodList = self.typeindex(off + 2)
+        name, end = self.name(off + 4)
+        return self.new(LfMethod, off, end, (
+            ("count", count),
+            ("methodList", methodList),
+            ("Name", name),
+        ))
+
+    def LfNestedType(self, off):
+        self.need(off, 2)
+        index = self.typeindex(off)
+        name, end = self.name(off + 2)
+        return self.new(LfNestedType, off, end, (
+            ("index", index),
+            ("Name", name),
+        ))
+
+    def LfVFuncTab(self, off):
+        self.need(off, 2)
+        return self.new(LfVFuncTab, off, off + 2, (("index", self.typeindex(off)),))
+
+    def LfOneMethod(self, off):
+        self.need(off, 4)
+        attr = self.attr(FieldAttributes, off)
+        index = self.typeindex(off + 2)
+        end = off + 4
+        vbaseoffset = None
+        if attr.mprop in ("intro", "pureintro"):
+            self.need(end, 4)
+            vbaseoffset, = u32.unpack_from(self.buf, end)
+            end += 4
+        name, end = self.name(end)
+        return self.new(LfOneMethod, off, end, (
+            ("attr", attr),
+            ("index", index),
+            ("vbaseoffset", vbaseoffset),
+            ("Name", name),
+        ))
+
+    def record(self, off):
+        # TypeRecord: Aligned(4, Length, Type, Data[Length - 2])
+        length, leaf_type = u16x2.unpack_from(self.buf, off)
+        end = off + 2 + length
+        if length < 2 or end > len(self.buf):
+            raise Unsupported()
+        decode = self.leaves[leaf_type]
+
+        # LazyTypes can decode other records while resolving type indexes
+        outer, self.end = self.end, end
+        try:
+            leaf = decode(off + 4)
+        finally:
+            self.end = outer
+        return leaf, end + (-(length + 2) % 4)
+
+    def next_record(self, off):
+        length, = u16.unpack_from(self.buf, off)
+        return off + 2 + length + (-(length + 2) % 4)
+
+    def construct_record(self, off, ctx):
+        self.stream.seek(off)
+        rec = TypeRecord._parsereport(self.stream, ctx, "(parsing) -> Records")
+        return rec.Data, self.stream.tell()
+
+def parse_records(stream, info, tpi):
+    """
+    Decode the type records following the TPI header.
+    Returns a list of (stream offset, leaf) and appends the leaves to tpi.types
+    """
+    stream.seek(0)
+    buf = stream.readview()
+    decoder = Decoder(stream, buf, tpi.types)
+
+    # context for falling back to construct, TypeRecord.parsed looks for ctx._.types
+    params = Container(types=tpi, _parsing=True, _building=False, _sizing=False)
+    params._params = params
+    ctx = Container(_=params, _params=params, _parsing=True, _building=False, _sizing=False)
+
+    # The decoder allocates hundreds of thousands of small containers, none of which are
+    # garbage yet. Letting the cyclic gc rescan them over and over costs more than the decoding.
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        records = []
+        off = info._addr + info._size
+        for _ in range(info.MaximumTI - info.MinimumTI):
+            try:
+                leaf, next_off = decoder.record(off)
+            except (Unsupported, KeyError, struct.error, UnicodeDecodeError, IndexError):
+                leaf, next_off = decoder.construct_record(off, ctx)
+            else:
+                leaf._idx = leaf.TI = len(tpi.types)
+                tpi.types.append(leaf)
+            records.append((off, leaf))
+            off = next_off
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+    return records
+
+
+class TypeSlot:
+    # Stands in for Types when construct parses a single record for LazyTypeList,
+    # TypeRecord.parsed takes the TI from len(types) and appends the leaf
+    def __init__(self, ti):
+        self.ti = ti
+        self.types = self
+
+    def __len__(self):
+        return self.ti
+
+    def append(self, leaf):
+        self.leaf = leaf
+
+
+class LazyTypeList:
+    """
+    Replaces Types.types for LazyTypes.
+    Each record is decoded and linked the first time its TI is accessed, which in turn
+    loads every type it references.
+    """
+
+    def __init__(self, tpi, stream, info, skiplist):
+        self.tpi = tpi
+        self.base = tpi.types
+        self.first = info.MinimumTI
+        self.count = info.MaximumTI - info.MinimumTI
+        self.loaded = [None] * self.count
+
+        stream.seek(0)
+        self.decoder = Decoder(stream, stream.readview(), self)
+
+        # Stream offset of each record, 0 if not known yet.
+        # Filled in from the skip list, and whenever we walk over records
+        start = info._addr + info._size
+        self.offsets = array('I', bytes(4 * self.count))
+        if self.count:
+            self.offsets[0] = start
+        for skip in skiplist:
+            if self.first <= skip.TI < self.first + self.count:
+                self.offsets[skip.TI - self.first] = start + skip.off
+
+    def offset(self, idx):
+        offsets = self.offsets
+        known = idx
+        while not offsets[known]:
+            known -= 1
+
+        off = offsets[known]
+        next_record = self.decoder.next_record
+        for i in range(known + 1, idx + 1):
+            off = offsets[i] = next_record(off)
+        return off
+
+    def load(self, idx):
+        ti = self.first + idx
+        off = self.offset(idx)
+        decoder = self.decoder
+        try:
+            leaf, _ = decoder.record(off)
+        except (Unsupported, KeyError, struct.error, UnicodeDecodeError, IndexError):
+            params = Container(types=self.tpi, _parsing=True, _building=False, _sizing=False)
+            params._params = params
+            slot = TypeSlot(ti)
+            ctx = Container(_=Container(types=slot), _params=params, _parsing=True, _building=False, _sizing=False)
+            decoder.construct_record(off, ctx)
+            leaf = slot.leaf
+        else:
+            leaf._idx = leaf.TI = ti
+
+        self.loaded[idx] = leaf
+        self.tpi.byRecOffset[off] = leaf
+        self.tpi.linkType(leaf)
+        return leaf
+
+    def __getitem__(self, ti):
+        if ti < self.first:
+            return self.base[ti]
+        idx = ti - self.first
+        leaf = self.loaded[idx]
+        if leaf is None:
+            leaf = self.load(idx)
+        return leaf
+
+    def __len__(self):
+        return self.first + self.count
+
+    def __iter__(self):
+        for ti in range(len(self)):
+            yield self[ti]
+
+    def record_name(self, idx):
+        """
+        Decodes just the name of a class, struct, union or enum record, without loading it.
+        Returns None for other records
+        """
+        decoder = self.decoder
+        off = self.offset(idx)
+        length, leaf_type = u16x2.unpack_from(decoder.buf, off)
+        data = off + 4
+        outer, decoder.end = decoder.end, off + 2 + length
+        try:
+            match leaf_type:
+                case LfClass.type | LfStruct.type:
+                    _, name = decoder.varint(data + 10)
+                case LfUnion.type:
+                    _, name = decoder.varint(data + 6)
+                case LfEnum.type:
+                    name = data + 8
+                case _:
+                    return None
+            return decoder.name(name)[0]
+        except (Unsupported, struct.error, UnicodeDecodeError):
+            # construct would fail on these too, leave it until it's loaded
+            return None
+        finally:
+            decoder.end = outer
+
+    def names(self):
+        # Maps names to TIs by decoding the name of every record
+        byName = defaultdict(list)
+        for idx in range(self.count):
+            name = self.record_name(idx)
+            if name is not None:
+                byName[name].append(self.first + idx)
+        return dict(byName)
+
+    def root(self, ti):
+        """
+        The type at the bottom of a chain of pointers, modifiers, arrays, bitfields and return types.
+        Every one of those includes the typestr of the root in its own typestr
+        """
+        if ti < self.first:
+            return ti
+        idx = ti - self.first
+        if (root := self.roots[idx]) is not None:
+            return root
+
+        root = ti
+        off = self.offset(idx)
+        length, leaf_type = u16x2.unpack_from(self.decoder.buf, off)
+        data = off + 4
+        match leaf_type:
+            case LfModifier.type | LfPointer.type | LfBitfield.type:
+                root, = u16.unpack_from(self.decoder.buf, data + 2)
+            case LfArray.type | LfProcedure.type | LfMemberFunction.type:
+                root, = u16.unpack_from(self.decoder.buf, data)
+        if root != ti and root < len(self):
+            root = self.root(root)
+        else:
+            root = ti
+        self.roots[idx] = root
+        return root
+
+    def byRoot(self):
+        self.roots = [None] * self.count
+        byRoot = defaultdict(list)
+        for idx in range(self.count):
+            ti = self.first + idx
+            byRoot[self.root(ti)].append(ti)
+        return dict(byRoot)
+
+
+# Number of buckets in the TPI hash stream
+TPI_BUCKETS = 0x1000
+
+class LazyNames:
+    """
+    Stands in for Types.byName.
+    Names are found through the per-TI bucket numbers from the TPI hash stream, so only
+    the names of the records in one bucket get decoded, and only the types with the
+    requested name get loaded.
+    If there are no buckets (or they don't match our hash function) it falls back to
+    decoding every record's name.
+    """
+    def __init__(self, types, buckets):
+        self.types = types
+        self.all = None
+        self.buckets = None
+        if buckets is not None and len(buckets) == types.count and self.check(buckets):
+            self.buckets = [[] for _ in range(TPI_BUCKETS)]
+            for idx, bucket in enumerate(buckets):
+                self.buckets[bucket].append(idx)
+        else:
+            self.all = types.names()
+
+    def check(self, buckets, samples=8):
+        # Make sure the names we can see hash to the buckets in the stream
+        checked = 0
+        for idx in range(self.types.count):
+            name = self.types.record_name(idx)
+            if name is None:
+                continue
+            if lhash(name) % TPI_BUCKETS != buckets[idx]:
+                return False
+            checked += 1
+            if checked == samples:
+                break
+        return True
+
+    def tis(self, name):
+        if self.all is not None:
+            return self.all.get(name, [])
+        types = self.types
+        return [types.first + idx for idx in self.buckets[lhash(name) % TPI_BUCKETS]
+                if types.record_name(idx) == name]
+
+    def __getitem__(self, name):
+        tis = self.tis(name)
+        if not tis:
+            raise KeyError(name)
+        return [self.types[ti] for ti in tis]
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        return bool(self.tis(name))
+
+    # Everything below needs every name
+    def names(self):
+        if self.all is None:
+            self.all = self.types.names()
+        return self.all
+
+    def __iter__(self):
+        return iter(self.names())
+
+    def __len__(self):
+        return len(self.names())
+
+    def keys(self):
+        return self.names().keys()
+
+    def items(self):
+        return ((name, self[name]) for name in self.names())
+
+
+class LazyTypes(Types):
+    """
+    Types which are only decoded (and linked) when something asks for them,
+    so a query that touches a few types doesn't pay for parsing the whole TPI.
+    Records are located through the skip list in the TPI hash stream.
+
+    Note: refs only has back-references from types which have been loaded
+    """
+
+    def __init__(self, msf, stream, info):
+        super().__init__()
+
+        info.parseHashes(msf)
+        self.types = LazyTypeList(self, stream, info, getattr(info, "skiplist", []))
+        self.buckets = getattr(info, "buckets", None)
+        self._byName = None
+        self.byRoot = None
+        self.strCache = {}
+
+    @property
+    def byName(self):
+        if self._byName is None:
+            self._byName = LazyNames(self.types, self.buckets)
+        return self._byName
+
+    @byName.setter
+    def byName(self, value):
+        self._byName = value
+
+    def fromOffset(self, offset):
+        # byRecOffset only has the types that have been loaded
+        types = self.types
+        for idx in range(types.count):
+            types.offset(idx)
+        idx = bisect.bisect_left(types.offsets, offset)
+        if idx < types.count and types.offsets[idx] == offset:
+            return types[types.first + idx]
+        return None
+
+    def candidates(self, name):
+        """
+        TIs of every type that could have name as its typestr.
+        Those are rooted at a base type or a named type that appears in name.
+        """
+        if self.byRoot is None:
+            self.byRoot = self.types.byRoot()
+            self.baseStrs = []
+            for ti, ty in enumerate(self.types.base):
+                try:
+                    self.baseStrs.append((ty.typestr(), ti))
+                except AttributeError:
+                    continue
+
+        roots = set(ti for s, ti in self.baseStrs if s in name)
+
+        # try every run of whole words as a type name
+        words = [m.span() for m in re.finditer(r"[\w$@?~]+", name)]
+        for i, (start, _) in enumerate(words):
+            for _, end in words[i:]:
+                roots.update(self.byName.tis(name[start:end]))
+
+        tis = set(roots)
+        for root in roots:
+            tis.update(self.byRoot.get(root, ()))
+        return sorted(tis)
+
+    def matches(self, name):
+        try:
+            return self.strCache[name]
+        except KeyError:
+            pass
+
+        types = []
+        for ti in self.candidates(name):
+            ty = self.types[ti]
+            if not ty:
+                continue
+            try:
+                if ty.typestr() == name:
+                    types.append(ty)
+            except (AttributeError, KeyError, TypeError, ValueError, NotImplementedError):
+                # Types which can't be rendered (like arrays of undefined forward refs) can't match
+                continue
+        self.strCache[name] = types
+        return types
+
+    def fromStr(self, name):
+        """
+        Find a type by its string representation.
+        Unlike Types.fromStr, only the types which could match are loaded and stringified.
+        """
+        if name in ("int", "unsigned int"):
+            types = self.matches("int32_t" if name == "int" else "uint32_t")[:1]
+        else:
+            types = self.matches(name)
+
+        if types:
+            if len(types) == 1:
+                return types[0]
+            breakpoint()
@@ -1,5 +1,17 @@
 from construct import *
 from constructutils import *
+import struct
+
+# The same as VarInt.subcon, for the decoders which don't go through construct
+VARINT_TYPES = {
+    0x8000: struct.Struct("<b"), # LF_CHAR
+    0x8001: struct.Struct("<h"), # LF_SHORT
+    0x8002: struct.Struct("<H"), # LF_USHORT
+    0x8003: struct.Struct("<i"), # LF_LONG
+    0x8004: struct.Struct("<I"), # LF_ULONG
+    0x8009: struct.Struct("<q"), # LF_QUADWORD
+    0x800a: struct.Struct("<Q"), # LF_UQUADWORD
+}
 
 # Some fields used this variable length integer encoding
 #   If the 16bit "typeOrVal" value is less than 0x8000, then the value is inlined (This might be limited to 8 bit values)
@@ -21,6 +33,25 @@ class VarInt(ConstructClass):
             )
         )
 
+    @classmethod
+    def neo_parse(cls, obj, buf, off, end, ctx):
+        start = off
+        if off + 2 > end:
+            raise StreamError(f"{cls.__name__} overran its end by {off + 2 - end} bytes")
+        typeOrVal = buf[off] | buf[off + 1] << 8
+        off += 2
+        if fmt := VARINT_TYPES.get(typeOrVal):
+            if off + fmt.size > end:
+                raise StreamError(f"{cls.__name__} overran its end by {off + fmt.size - end} bytes")
+            value, = fmt.unpack_from(buf, off)
+            off += fmt.size
+        else:
+            value = typeOrVal
+
+        self = cls.__new__(cls)
+        dict.update(self, _addr=start, _size=off - start, typeOrVal=typeOrVal, value=value)
+        return self, off
+
     def __eq__(self, other):
         return self.value == other
 
@@ -1,3 +1,6 @@
+from array import array
+from bisect import bisect_left
+
 from iced_x86 import Decoder, Formatter, FormatterSyntax, Mnemonic, OpKind, Register, MemorySize
 
 def create_enum_dict(module):
@@ -78,10 +81,14 @@ class Instruction:
         self.instr = instr
 
 
-formatter = Formatter(FormatterSyntax.MASM)
-formatter.hex_prefix = "0x"
-formatter.hex_suffix = ""
-formatter.space_after_operand_separator = True
+def new_formatter():
+    formatter = Formatter(FormatterSyntax.MASM)
+    formatter.hex_prefix = "0x"
+    formatter.hex_suffix = ""
+    formatter.space_after_operand_separator = True
+    return formatter
+
+formatter = new_formatter()
 
 
 
@@ -132,4 +139,72 @@ def disassemble(data, addr=0):
     instrs = []
     for instr in decoder:
         instrs.append(instr)
-    return instrs
\ No newline at end of file
+    return instrs
+
+class CodeSweep:
+    """
+    Linear sweep of every function in a code section, decoded once in address order.
+    Functions pull their instructions out of here instead of each creating a Decoder.
+
+    Switch tables and other data inside functions desync the sweep, decode() falls
+    back to decoding from the exact address until it lines up with the sweep again.
+    """
+    def __init__(self, section, ranges):
+        self.va = section.va
+        self.data = section.data
+        self.decoder = Decoder(32, self.data, ip=self.va)
+
+        # instruction boundaries and the instructions that start there
+        self.addrs = array('I')
+        self.insts = []
+
+        calls = set()
+        jumps = set()
+
+        decoder = self.decoder
+        end = 0
+        for start, stop in sorted(ranges):
+            # skip anything already covered by an overlapping function
+            start = max(start, end)
+            if start >= stop:
+                continue
+            decoder.position = start
+            decoder.ip = self.va + start
+            while decoder.position < stop and decoder.can_decode:
+                inst = decoder.decode()
+                self.addrs.append(inst.ip32)
+                self.insts.append(inst)
+                if inst.op0_kind == OpKind.NEAR_BRANCH32:
+                    if inst.mnemonic == Mnemonic.CALL:
+                        calls.add(inst.near_branch32)
+                    else:
+                        jumps.add(inst.near_branch32)
+            end = decoder.position
+
+        self.call_targets = array('I', sorted(calls))
+        self.branch_targets = array('I', sorted(jumps))
+
+    def decode(self, addr, end):
+        """Yields the instructions from addr up to end"""
+        addrs = self.addrs
+        insts = self.insts
+        i = bisect_left(addrs, addr)
+        while addr < end:
+            if i < len(addrs) and addrs[i] == addr and insts[i].next_ip32 <= end:
+                inst = insts[i]
+                i += 1
+            else:
+                inst = self.decode_one(addr, end)
+                i = bisect_left(addrs, inst.next_ip32, i)
+            addr = inst.next_ip32
+            yield inst
+
+    def decode_one(self, addr, end):
+        decoder = self.decoder
+        decoder.position = addr - self.va
+        decoder.ip = addr
+        inst = decoder.decode()
+        if inst.next_ip32 > end:
+            # runs past the end, decode it the same as if the data stopped at end
+            inst = Decoder(32, self.data[addr - self.va:end - self.va], ip=addr).decode()
+        return inst